@@ -3,7 +3,7 @@ Depot-Create - Datastore hash list
 """
 
 import argparse,humanfriendly,logging,os       #Helpers
-from delib import Delib,DelibDataDir,DelibRestore    #Dedup-Server
+from delib import Delib,DelibDataDir,DelibRestore,DelibOutput    #Dedup-Server
 from tqdm import tqdm #Progress bar
 
 LOGLEVEL=logging.DEBUG
@@ -14,22 +14,37 @@ class DedupRestore(Delib):
 
     VERSION = 2019.300 #Year.Yearday
 
-    def __init__(self,dir,host,name):
+    def __init__(self,dir,host,name,output=None,workers=1,readahead=None,cache_size=None):
         logging.info("Datastore directory {}".format(dir))
         self.data = DelibDataDir(dir)
-        self.prepareStdOut()
+        if cache_size is not None:
+            self.data.setBlockCacheSize(cache_size)
+        if output:
+            logging.info("Restoring to {}".format(output))
+            self.raw_out = open(output,"wb")
+        else:
+            self.prepareStdOut()
+        out = DelibOutput(self.raw_out)
 
 
-        restore = DelibRestore(data=self.data,host=host,name=name)
-        block_cnt = len(restore.db_blocks)
-        logging.info("Loaded backup. Have {} blocks".format(block_cnt))
-        progress = tqdm(desc=host+"|"+name,total=block_cnt,unit="blocks",leave=False)
+        with DelibRestore(data=self.data,host=host,name=name,workers=workers,readahead=readahead) as restore:
+            block_cnt = restore.getBlockCount()
+            logging.info("Loaded backup. Have {} blocks".format(block_cnt))
+            progress = tqdm(desc=host+"|"+name,total=block_cnt,unit="blocks",leave=False)
 
-        for block in restore:
-            block.writeFP(self.raw_out,compressed=False)
-            progress.update()
+            for block in restore:
+                out.write(block)
+                progress.update()
 
+        out.close()
+        if output:
+            self.raw_out.close()
         progress.close()
+        if out.isSparse():
+            logging.info("Skipped {} of zero blocks".format(humanfriendly.format_size(out.cnt_sparse,binary=True)))
+        cache = self.data.getBlockCache()
+        if cache:
+            logging.info("Block cache: {} hits, {} misses".format(cache.hits,cache.misses))
         logging.info("Done restoring.")
 
 
@@ -39,6 +54,10 @@ def parse_arguments():
      parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
      parser.add_argument("--host",nargs=1,required=True,help="Backup host")
      parser.add_argument("--name",nargs=1,required=True,help="Backup name")
+     parser.add_argument("--output",nargs=1,required=False,default=[None],help="Restore to file or block device instead of STDOUT. Zero blocks are skipped sparse")
+     parser.add_argument("--workers",nargs=1,required=False,default=[1],type=int,help="Threads reading and decompressing blocks ahead (Default: 1)")
+     parser.add_argument("--readahead",nargs=1,required=False,default=[None],type=int,help="Block files read ahead by the workers (Default: 4 per worker)")
+     parser.add_argument("--cache",nargs=1,required=False,default=["256M"],help="Memory for decompressed blocks repeated within the backup, 0 to disable (Default: 256M)")
      args = parser.parse_args()
      return args
 
@@ -47,4 +66,4 @@ if __name__ == "__main__":
     logging.debug("Called: __main__")
     args = parse_arguments()
     logging.info("Starting DedupRestore()")
-    dedup = DedupRestore(dir=args.dir[0],host=args.host[0],name=args.name[0])
+    dedup = DedupRestore(dir=args.dir[0],host=args.host[0],name=args.name[0],output=args.output[0],workers=args.workers[0],readahead=args.readahead[0],cache_size=humanfriendly.parse_size(args.cache[0],binary=True))
@@ -1,8 +1,88 @@
 import sqlite3,re #Server
-import sys,os,stat,io,struct,socket,time,fcntl #Python3 libraries
+import sys,os,errno,stat,io,struct,socket,time,fcntl,collections,concurrent.futures,threading,array,bisect,mmap,ctypes #Python3 libraries
 import xxhash,lz4.frame,tarfile #Dedup
 import humanfriendly, logging, math #Helpers
 #from tqdm import tqdm #Progress bar
+try:
+    import zstandard #Optional codec
+except ImportError:
+    zstandard = None
+
+##
+## Compression codecs
+##
+## Registry of the codecs blocks are stored with. The codec name is stored per block in blocks.compressed, so
+## blocks of different codecs live side by side and are decompressed by the codec they were stored with.
+## The empty name stores a block raw. zstd needs the zstandard module.
+##
+class DelibCodec:
+
+    RAW = ""
+    LZ4 = "lz4"
+    ZSTD = "zstd"
+
+    NAME_RAW = "none"           #Name of RAW in codec specs
+    ZSTD_LEVEL = 3              #Default level of zstd
+
+    codecs = {}                 #Name: (block file extension, compress(data,level), decompress(data))
+    local = threading.local()   #zstd contexts by thread, they must not be shared
+
+    @classmethod
+    def register(cls,name,extension,compress,decompress):
+        cls.codecs[name] = (extension,compress,decompress)
+
+    #Parses a codec spec of name and optional level, e.g. "zstd:19", into (name,level). Level is None for the default
+    @classmethod
+    def parse(cls,spec):
+        name,_,level = spec.partition(":")
+        name = cls.RAW if name == cls.NAME_RAW else name
+        cls._get(name)
+        return name,(int(level) if level else None)
+
+    @classmethod
+    def compress(cls,name,data,level=None):
+        return cls._get(name)[1](data,level)
+
+    @classmethod
+    def decompress(cls,name,data):
+        return cls._get(name or cls.RAW)[2](data)
+
+    @classmethod
+    def getExtension(cls,name):
+        return cls._get(name)[0]
+
+    @classmethod
+    def getExtensions(cls):
+        return tuple(codec[0] for codec in cls.codecs.values())
+
+    @classmethod
+    def _get(cls,name):
+        if name not in cls.codecs:
+            if name == cls.ZSTD:
+                raise Exception("Codec zstd needs the zstandard module: pip3 install zstandard")
+            raise Exception("Unsupported codec {}. Must be one of {}".format(name,", ".join(known or cls.NAME_RAW for known in cls.codecs)))
+        return cls.codecs[name]
+
+    @classmethod
+    def _zstdCompress(cls,data,level):
+        level = cls.ZSTD_LEVEL if level is None else level
+        compressors = cls.local.__dict__.setdefault("compressors",{})
+        if level not in compressors:
+            compressors[level] = zstandard.ZstdCompressor(level=level)
+        return compressors[level].compress(data)
+
+    @classmethod
+    def _zstdDecompress(cls,data):
+        if not hasattr(cls.local,"decompressor"):
+            cls.local.decompressor = zstandard.ZstdDecompressor()
+        return cls.local.decompressor.decompress(data)
+
+DelibCodec.register(DelibCodec.RAW,".raw",lambda data,level: bytes(data),lambda data: data)
+DelibCodec.register(DelibCodec.LZ4,".lz4",lambda data,level: lz4.frame.compress(data,compression_level=level or 0),lz4.frame.decompress)
+if zstandard:
+    DelibCodec.register(DelibCodec.ZSTD,".zst",DelibCodec._zstdCompress,DelibCodec._zstdDecompress)
+
+
 
 ##
 ## Block handling
@@ -10,21 +90,77 @@ import humanfriendly, logging, math #Helpers
 class DelibBlock:
 
     @classmethod
-    def fromCompressed(cls,cblock,hash=None):
-        block = lz4.frame.decompress(cblock)
+    def fromCompressed(cls,cblock,hash=None,codec=DelibCodec.LZ4):
+        block = DelibCodec.decompress(codec,cblock)
         return cls(block,hash)
 
+    #Keeps an lz4 frame as-is for storing it without transcoding.
+    #The frame is only decompressed (in chunks, never fully) to verify the hash or if the frame carries no content size
     @classmethod
-    def fromFile(cls,file,compressed):
+    def fromFrame(cls,cblock,hash=None,verify=True):
+        size = lz4.frame.get_frame_info(cblock)["content_size"]
+        if verify or not size:
+            hasher = xxhash.xxh64() if verify else None
+            size = 0
+            decompressor = lz4.frame.LZ4FrameDecompressor()
+            chunk = decompressor.decompress(cblock,max_length=cls.FRAME_CHUNK)
+            while True:
+                size += len(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                if decompressor.eof:
+                    break
+                if not decompressor.needs_input:
+                    chunk = decompressor.decompress(b"",max_length=cls.FRAME_CHUNK)
+                else:
+                    raise RuntimeError("Truncated lz4 frame")
+            if hasher:
+                hash = hasher.hexdigest()
+        block = cls(None,hash)
+        block.cblock = cblock
+        block.codec = DelibCodec.LZ4
+        block.size = size
+        return block
+
+    @classmethod
+    def fromFile(cls,file,codec):
         with open(file,"rb") as fp:
             block = fp.read()
-        if compressed:
-            try:
-                return cls.fromCompressed(block)
-            except RuntimeError as e:
-                raise Exception("Decompression failed for {}. {}".format(file,str(e)))
-        else:
+        return cls.fromStored(block,codec,file)
+
+    #Block as stored in a block file or pack with the codec of its blocks row. name is only used for error messages
+    @classmethod
+    def fromStored(cls,block,codec,name):
+        if not codec:
+            #Raw blocks are used as read
             return cls(block)
+        try:
+            return cls.fromCompressed(block,codec=codec)
+        except Exception as e:
+            raise Exception("Decompression failed for {}. {}".format(name,str(e)))
+
+    FRAME_CHUNK = 1024 * 1024   #Decompression chunk size of fromFrame()
+
+    #Hashes are handled as 16-char hex strings and stored in the database as signed 64bit integer
+    @staticmethod
+    def hashToInt(hash):
+        value = int(hash,16)
+        if value >= 1 << 63:
+            value -= 1 << 64
+        return value
+
+    @staticmethod
+    def intToHash(value):
+        return "{:016x}".format(value & 0xFFFFFFFFFFFFFFFF)
+
+    #All-zero block of the given size, e.g. unallocated space of a block device
+    @classmethod
+    def zero(cls,size,hash=None):
+        block = cls(bytes(size),hash)
+        block.is_zero = True
+        return block
+
+    is_zero = False
 
     def __init__(self,block,hash=None):
         self.block = block
@@ -33,19 +169,47 @@ class DelibBlock:
         else:
             self.getHash()
 
+    #Uncompressed block. Decompressed on demand for blocks created by fromFrame()
+    def getBlock(self):
+        if self.block is None:
+            self.block = DelibCodec.decompress(self.codec,self.cblock)
+        return self.block
+
     hash = None
     def getHash(self,update=False):
         if not self.hash or update:
-            self.hash = xxhash.xxh64(self.block).hexdigest()
+            self.hash = xxhash.xxh64(self.getBlock()).hexdigest()
         return self.hash
 
+    size = None
     def getSize(self):
-        return len(self.block)
+        if self.size is None:
+            self.size = len(self.block)
+        return self.size
 
     cblock = None
+    codec = None        #Codec of cblock
+    encoded = None      #Codec of the last encode(), cblock may be raw instead
+    #Block as stored, compressed with lz4 unless encoded otherwise
     def getCompressed(self):
-        if not self.cblock:
-            self.cblock = lz4.frame.compress(self.block)
+        if self.cblock is None:
+            self.encode()
+        return self.cblock
+
+    def getCodec(self):
+        self.getCompressed()
+        return self.codec
+
+    #Compresses the block with a codec unless it already is. Blocks that do not shrink are stored raw,
+    #so reading them never pays for decompression that saves nothing
+    def encode(self,codec=DelibCodec.LZ4,level=None):
+        if self.cblock is None or codec not in (self.codec,self.encoded):
+            self.cblock = DelibCodec.compress(codec,self.getBlock(),level)
+            self.codec = codec
+        self.encoded = codec
+        if self.codec != DelibCodec.RAW and len(self.cblock) >= self.getSize():
+            self.cblock = bytes(self.getBlock())
+            self.codec = DelibCodec.RAW
         return self.cblock
 
     def getCompressedSize(self):
@@ -62,12 +226,560 @@ class DelibBlock:
         if compressed:
             fp.write(self.getCompressed())
         else:
-            fp.write(self.block)
+            fp.write(self.getBlock())
+        return True
+
+
+
+
+##
+## Content-defined chunking
+##
+## Splits a stream into chunks at positions defined by their content, so an insertion only changes the chunks
+## around it instead of shifting every later block. Uses RAM (Rapid Asymmetric Maximum): a chunk ends at the first
+## byte after a window of the minimum size that is at least as large as the largest byte within the window.
+## Both scans run in C (max() and a regular expression), there is no per-byte rolling hash in Python.
+## Runs of zeros are cut at the maximum size, so unallocated space maps to the zero block of the datastore.
+##
+class DelibChunker:
+
+    MAX_FACTOR = 4                  #Maximum chunk size as multiple of the window
+    READ_SIZE = 8 * 1024 * 1024     #Bytes read from the stream at once
+
+    #Bytes at least as large as the index
+    PATTERNS = [re.compile("[\\x{:02x}-\\xff]".format(value).encode("ascii")) for value in range(256)]
+    NONZERO = re.compile(b"[^\\x00]")
+
+    def __init__(self,size):
+        self.window = size
+        self.max_size = size * self.MAX_FACTOR
+        self.read_size = max(self.READ_SIZE,self.max_size)
+
+    #Chunks of the stream as bytes
+    def chunks(self,fp):
+        buf = bytearray()
+        start = 0
+        eof = False
+        while True:
+            #A chunk never ends beyond max_size, so that much must be buffered unless the stream ended
+            if not eof and len(buf) - start < self.max_size:
+                del buf[:start]
+                start = 0
+                while len(buf) < self.read_size:
+                    data = fp.read(self.read_size - len(buf))
+                    if not data:
+                        eof = True
+                        break
+                    buf += data
+            if start >= len(buf):
+                return
+            cut = self._cut(buf,start)
+            yield bytes(buf[start:cut])
+            start = cut
+
+    #End of the chunk starting at start
+    def _cut(self,buf,start):
+        end = min(len(buf),start + self.max_size)
+        window = start + self.window
+        if end <= window:
+            return end
+        #Fast path for binary data, which almost always contains 0xff within the window
+        top = 255 if buf.find(255,start,window) >= 0 else max(buf[start:window])
+        if top == 0:
+            #Zeros up to the first other byte
+            match = self.NONZERO.search(buf,window,end)
+            return match.start() if match else end
+        match = self.PATTERNS[top].search(buf,window,end)
+        return match.start() + 1 if match else end
+
+
+
+
+##
+## Hash index
+##
+## Compact in-memory set of all block hashes for dedup lookups without database queries.
+## Hashes loaded from the database are kept as sorted array of their 64bit integer values (8 bytes per block)
+## and searched with bisect, hashes added afterwards are kept in a regular set. One index may be shared by threads:
+## lookups and add() are single set operations, atomic under the GIL.
+##
+class DelibHashIndex:
+
+    def __init__(self,values=()):
+        #values must be sorted integer hashes as stored in the database
+        self.sorted = array.array("q",values)
+        self.added = set()
+
+    def __contains__(self,hash):
+        try:
+            value = DelibBlock.hashToInt(hash)
+        except ValueError:
+            return False
+        if value in self.added:
+            return True
+        i = bisect.bisect_left(self.sorted,value)
+        return i < len(self.sorted) and self.sorted[i] == value
+
+    def __len__(self):
+        return len(self.sorted) + len(self.added)
+
+    def add(self,hash):
+        self.added.add(DelibBlock.hashToInt(hash))
+
+    def addValue(self,value):
+        self.added.add(value)
+
+
+
+
+##
+## Block cache
+##
+## LRU cache of decompressed blocks by hash with a byte budget. Shared by all restores and getBlockByHash()
+## of a DelibDataDir, so hot blocks of repetitive images are served from memory. Thread-safe for restore workers.
+##
+class DelibBlockCache:
+
+    def __init__(self,max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.blocks = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    #Cached block or None
+    def get(self,hash):
+        with self.lock:
+            block = self.blocks.get(hash)
+            if block is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(hash)
+            self.hits += 1
+            return block
+
+    def put(self,block):
+        size = block.getSize()
+        if size > self.max_size:
+            return
+        with self.lock:
+            if block.getHash() in self.blocks:
+                return
+            self.blocks[block.getHash()] = block
+            self.size += size
+            while self.size > self.max_size:
+                hash,old = self.blocks.popitem(last=False)
+                self.size -= old.getSize()
+
+
+
+
+##
+## Block map
+##
+## Binary list of all block hashes of a backup in position order, stored as maps/{backup id}.map
+## instead of one backup_blocks row per position. Written in one sequential pass and read via mmap.
+## All values little-endian.
+## Format 1: header (magic, format version, reserved, number of positions) followed by one signed 64bit
+##           integer hash per position.
+## Format 2: header (magic, format version, reserved, number of runs, number of positions) followed by
+##           one run per group of consecutive identical hashes: signed 64bit integer hash, 32bit run length.
+##
+class DelibBlockMap:
+
+    MAGIC = b"DLBM"
+    FORMAT = 2
+    PREFIX = struct.Struct("<4sH")
+    HEADER_V1 = struct.Struct("<4sHHQ")
+    ENTRY_V1 = struct.Struct("<q")
+    HEADER = struct.Struct("<4sHHQQ")
+    ENTRY = struct.Struct("<qI")
+    MAX_RUN = 0xFFFFFFFF
+
+    def __init__(self,path):
+        self.path = path
+        with open(path,"rb") as fp:
+            self.mm = mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+        magic,self.format = self.PREFIX.unpack_from(self.mm,0)
+        if magic != self.MAGIC or self.format not in (1,2):
+            raise Exception("Not a supported block map: {}".format(path))
+        if self.format == 1:
+            magic,format,reserved,self.count = self.HEADER_V1.unpack_from(self.mm,0)
+            self.run_count = self.count
+            self.offset,entry = self.HEADER_V1.size,self.ENTRY_V1
+        else:
+            magic,format,reserved,self.run_count,self.count = self.HEADER.unpack_from(self.mm,0)
+            self.offset,entry = self.HEADER.size,self.ENTRY
+        if len(self.mm) != self.offset + self.run_count * entry.size:
+            raise Exception("Block map {} is truncated: expected {} entries".format(path,self.run_count))
+
+    #Number of positions
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for value,count in self.runs():
+            hash = DelibBlock.intToHash(value)
+            for i in range(count):
+                yield hash
+
+    #Integer hash and run length of each run in position order
+    def runs(self):
+        view = memoryview(self.mm)[self.offset:]
+        if self.format == 1:
+            for (value,) in self.ENTRY_V1.iter_unpack(view):
+                yield value,1
+        else:
+            for value,count in self.ENTRY.iter_unpack(view):
+                yield value,count
+
+    #Integer hashes, one per run
+    def values(self):
+        for value,count in self.runs():
+            yield value
+
+    def close(self):
+        self.mm.close()
+
+class DelibBlockMapWriter:
+
+    BUFFER = 65536      #Runs buffered per write
+
+    def __init__(self,path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.count = 0
+        self.run_count = 0
+        self.run_value = None
+        self.run_length = 0
+        self.buffer = bytearray()
+        self.fp = open(self.tmp_path,"wb")
+        self.fp.write(DelibBlockMap.HEADER.pack(DelibBlockMap.MAGIC,DelibBlockMap.FORMAT,0,0,0))
+
+    #Consecutive identical hashes are merged into one run
+    def append(self,hash,count=1):
+        value = DelibBlock.hashToInt(hash)
+        if value == self.run_value and self.run_length + count <= DelibBlockMap.MAX_RUN:
+            self.run_length += count
+        else:
+            self._endRun()
+            self.run_value = value
+            self.run_length = count
+        self.count += count
+
+    def _endRun(self):
+        if self.run_length:
+            self.buffer += DelibBlockMap.ENTRY.pack(self.run_value,self.run_length)
+            self.run_count += 1
+            if len(self.buffer) >= self.BUFFER * DelibBlockMap.ENTRY.size:
+                self._flush()
+        self.run_length = 0
+
+    def _flush(self):
+        self.fp.write(self.buffer)
+        self.buffer = bytearray()
+
+    #Writes the header counts and moves the map into place. Returns the number of positions
+    def close(self):
+        self._endRun()
+        self._flush()
+        self.fp.seek(0)
+        self.fp.write(DelibBlockMap.HEADER.pack(DelibBlockMap.MAGIC,DelibBlockMap.FORMAT,0,self.run_count,self.count))
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.rename(self.tmp_path,self.path)
+        return self.count
+
+    def abort(self):
+        self.fp.close()
+        os.remove(self.tmp_path)
+
+
+
+
+##
+## Packfiles
+##
+## Append-only segment files packs/{pack id}.pack holding many stored blocks instead of one file per block.
+## Format: header (magic, format version) followed by one record per block: record header (signed 64bit integer
+## hash, 32bit payload length) and the payload exactly as it would be stored in a block file. All values little-endian.
+## The blocks table references the payload by (pack, pack_offset, csize).
+## A pack is appended to by one writer at a time, guarded by lockf. Full or locked packs make the writer start a new one.
+## Appended blocks must be synced with sync() before the rows pointing to them are committed.
+##
+class DelibPackWriter:
+
+    MAGIC = b"DLPK"
+    FORMAT = 1
+    HEADER = struct.Struct("<4sH")
+    RECORD = struct.Struct("<qI")
+    MAX_SIZE = 1024 * 1024 * 1024   #Bytes per pack before starting a new one
+
+    #Record locks belong to the process, packs of the writers within one process are tracked here
+    inuse = set()
+    inuselock = threading.Lock()
+
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+        self.dirty = False      #Appended since the last sync()
+
+    #Appends a stored block. Returns (pack id, payload offset). Safe to call from worker threads
+    def append(self,value,payload):
+        with self.lock:
+            length = self.RECORD.size + len(payload)
+            if self.fd is None or self.size + length > self.MAX_SIZE:
+                self._open(length)
+            offset = self.size + self.RECORD.size
+            written = os.writev(self.fd,[self.RECORD.pack(value,len(payload)),payload])
+            if written != length:
+                raise Exception("Short write to pack {}".format(self.id))
+            self.size += written
+            self.dirty = True
+            return self.id,offset
+
+    #Flushes appended blocks to disk. Full packs are synced when the writer moves on to the next one
+    def sync(self):
+        with self.lock:
+            if self.fd is not None and self.dirty:
+                os.fsync(self.fd)
+                self.dirty = False
+
+    #Locks an existing pack against appending by any writer, e.g. while it is compacted. The pack is not appended
+    #to by this writer. Returns False if another writer holds it
+    def hold(self,id):
+        with self.lock:
+            self._close()
+            return self._tryOpen(id,os.O_WRONLY | os.O_APPEND)
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.fd is not None:
+            if self.dirty:
+                os.fsync(self.fd)
+                self.dirty = False
+            os.close(self.fd)
+            self.fd = None
+            with self.inuselock:
+                self.inuse.discard(self._path(self.id))
+
+    def _path(self,id):
+        return "{}/{}.pack".format(os.path.realpath(self.path),id)
+
+    #Continues the last pack if length bytes fit and it is not locked by another writer, otherwise starts a new one
+    def _open(self,length):
+        self._close()
+        ids = [int(name[:-5]) for name in os.listdir(self.path) if name.endswith(".pack") and name[:-5].isdigit()]
+        last = max(ids,default=0)
+        if last and self._tryOpen(last,os.O_WRONLY | os.O_APPEND):
+            if self.size + length <= self.MAX_SIZE:
+                return
+            self._close()
+        while True:
+            last += 1
+            if self._tryOpen(last,os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL):
+                os.write(self.fd,self.HEADER.pack(self.MAGIC,self.FORMAT))
+                self.size = self.HEADER.size
+                return
+
+    def _tryOpen(self,id,flags):
+        path = self._path(id)
+        with self.inuselock:
+            if path in self.inuse:
+                return False
+            try:
+                fd = os.open(path,flags,0o644)
+            except FileExistsError:
+                return False
+            try:
+                fcntl.lockf(fd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self.inuse.add(path)
+        self.fd = fd
+        self.id = id
+        self.size = os.fstat(fd).st_size
         return True
 
 
 
 
+##
+## Hash list export
+##
+## Compact hash lists for the client handshake. Both formats are a single lz4 frame starting with a header.
+## list:  header (magic "DLHL", format version), then the hashes as unsigned 64bit values in ascending order, each
+##        as LEB128 varint of its difference to the previous one (the first to 0)
+## bloom: header (magic "DLBF", format version, bits m, hashes n, probes k as <4sHQQB), then m bits, bit i in byte
+##        i//8 at i%8. Hash h sets bits (h1 + i*h2) % m for i < k with h1 = low 32 bits of h, h2 = high 32 bits | 1
+##
+class DelibHashExport:
+
+    FORMAT_LIST = "list"
+    FORMAT_BLOOM = "bloom"
+    MAGIC_LIST = b"DLHL"
+    MAGIC_BLOOM = b"DLBF"
+    FORMAT = 1
+    HEADER_LIST = struct.Struct("<4sH")
+    HEADER_BLOOM = struct.Struct("<4sHQQB")
+    BLOOM_FP_RATE = 0.01            #Default false positive rate
+    CHUNK_SIZE = 1024 * 1024        #Bytes compressed at once
+    MASK = 0xffffffffffffffff
+
+    #Values are integer hashes in ascending unsigned order
+    @classmethod
+    def writeList(cls,fp,values):
+        compressor = lz4.frame.LZ4FrameCompressor()
+        fp.write(compressor.begin())
+        buf = bytearray(cls.HEADER_LIST.pack(cls.MAGIC_LIST,cls.FORMAT))
+        last = 0
+        for value in values:
+            value &= cls.MASK
+            delta = value - last
+            last = value
+            while delta > 0x7f:
+                buf.append((delta & 0x7f) | 0x80)
+                delta >>= 7
+            buf.append(delta)
+            if len(buf) >= cls.CHUNK_SIZE:
+                fp.write(compressor.compress(bytes(buf)))
+                buf.clear()
+        fp.write(compressor.compress(bytes(buf)))
+        fp.write(compressor.flush())
+
+    #Values are count integer hashes. The filter is sized for fp_rate false positives at count hashes
+    @classmethod
+    def writeBloom(cls,fp,values,count,fp_rate=BLOOM_FP_RATE):
+        bits = max(8,math.ceil(-max(count,1) * math.log(fp_rate) / (math.log(2) ** 2)))
+        bits += -bits % 8
+        probes = max(1,round(bits / max(count,1) * math.log(2)))
+        bloom = bytearray(bits // 8)
+        for value in values:
+            value &= cls.MASK
+            h1 = value & 0xffffffff
+            h2 = (value >> 32) | 1
+            for i in range(probes):
+                bit = (h1 + i * h2) % bits
+                bloom[bit >> 3] |= 1 << (bit & 7)
+        compressor = lz4.frame.LZ4FrameCompressor()
+        fp.write(compressor.begin())
+        fp.write(compressor.compress(cls.HEADER_BLOOM.pack(cls.MAGIC_BLOOM,cls.FORMAT,bits,count,probes)))
+        for pos in range(0,len(bloom),cls.CHUNK_SIZE):
+            fp.write(compressor.compress(bytes(bloom[pos:pos+cls.CHUNK_SIZE])))
+        fp.write(compressor.flush())
+
+
+
+##
+## Rate limit
+##
+## Throttles a loop to an average number of units (e.g. bytes) per second since its start
+##
+class DelibRateLimit:
+
+    def __init__(self,rate):
+        self.rate = rate        #0 for unlimited
+        self.start = time.monotonic()
+        self.total = 0
+
+    def consume(self,amount):
+        if not self.rate:
+            return
+        self.total += amount
+        wait = self.total / self.rate - (time.monotonic() - self.start)
+        if wait > 0:
+            time.sleep(wait)
+
+
+
+
+##
+## Restore output
+##
+## Writes restored blocks to a file, block device or stream. All-zero blocks are not written to seekable targets:
+## regular files get a hole by seeking over them and are truncated to their final size on close,
+## block devices get the range punched with fallocate(PUNCH_HOLE), falling back to writing zeros.
+## Pipes and other streams get every byte.
+##
+class DelibOutput:
+
+    FALLOC_FL_KEEP_SIZE = 0x01
+    FALLOC_FL_PUNCH_HOLE = 0x02
+    ZERO_CHUNK = 1024 * 1024    #Write size when zeros have to be written
+
+    def __init__(self,fp):
+        self.fp = fp
+        mode = os.fstat(fp.fileno()).st_mode
+        #Appending writes ignore the file position
+        append = fcntl.fcntl(fp.fileno(),fcntl.F_GETFL) & os.O_APPEND
+        self.is_file = stat.S_ISREG(mode) and not append
+        self.is_device = stat.S_ISBLK(mode)
+        self.pos = fp.tell() if self.is_file or self.is_device else 0
+        self.hole = 0           #Pending zero bytes at pos
+        self.cnt_sparse = 0     #Bytes skipped or punched instead of written
+
+    def isSparse(self):
+        return self.is_file or self.is_device
+
+    def write(self,block):
+        if block.is_zero and self.isSparse():
+            self.hole += block.getSize()
+            return
+        self._flushHole()
+        block.writeFP(self.fp,compressed=False)
+        self.pos += block.getSize()
+
+    def close(self):
+        self._flushHole()
+        if self.is_file:
+            self.fp.truncate(self.pos)
+        self.fp.flush()
+
+    def _flushHole(self):
+        if not self.hole:
+            return
+        if self.is_file or self._punch(self.pos,self.hole):
+            self.fp.seek(self.pos + self.hole)
+            self.cnt_sparse += self.hole
+        else:
+            self._writeZeros(self.hole)
+        self.pos += self.hole
+        self.hole = 0
+
+    #Deallocates a range of a block device. Returns False if the device or kernel does not support it
+    _fallocate = None
+    def _punch(self,offset,length):
+        if self._fallocate is False:
+            return False
+        if self._fallocate is None:
+            try:
+                libc = ctypes.CDLL(None,use_errno=True)
+                self._fallocate = libc.fallocate
+                self._fallocate.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.c_longlong,ctypes.c_longlong]
+            except (OSError,AttributeError):
+                self._fallocate = False
+                return False
+        self.fp.flush()
+        if self._fallocate(self.fp.fileno(),self.FALLOC_FL_PUNCH_HOLE | self.FALLOC_FL_KEEP_SIZE,offset,length) != 0:
+            logging.warning("Cannot punch holes into output, writing zeros instead: {}".format(os.strerror(ctypes.get_errno())))
+            self._fallocate = False
+            return False
+        return True
+
+    def _writeZeros(self,length):
+        self.fp.seek(self.pos)
+        zeros = bytes(min(length,self.ZERO_CHUNK))
+        while length > 0:
+            length -= self.fp.write(zeros[:length])
+
+
 
 
 ###
@@ -83,6 +795,8 @@ class DelibBlock:
 
 class DelibBackup:
 
+    LINK_BATCH = 10000          #Runs inserted per executemany() by linkMany()
+
     def __init__(self,data,host,name,device,time_created):
         self.host = host
         self.name = name
@@ -90,40 +804,247 @@ class DelibBackup:
         self.id = self.data._DBCreateBackup(host=host,name=name,device=device,time_created=time_created)
 
     def finish(self,size):
-        self.data._DBFinishBackup(host=self.host,name=self.name,size=size)
-
-    def link(self,pos,hash,do_commit=True):
+        #Blocks are counted once the backup is completely linked
+        self.data.referenceBackup(self.id)
+        if not self.data._DBFinishBackup(self.id,size=size):
+            #Failed by depot-clean.py meanwhile, its blocks must not stay counted
+            self.data.releaseBackup(self.id)
+            raise Exception("Backup {} of host {} is no longer pending".format(self.name,self.host))
+
+    #Links count consecutive positions starting at pos to hash
+    def link(self,pos,hash,count=1,do_commit=True):
         if not hash:
             raise Exception("Hash is not defined")
-        self.data._DBLinkBackupHash(self.id,hash,pos,do_commit=do_commit)
+        self.data._DBLinkBackupHash(self.id,hash,pos,count=count,do_commit=do_commit)
+
+    #Links runs of (pos,hash,count) as produced by runLength() in chunks of LINK_BATCH rows, each committed on its
+    #own. runs may be streamed from a slow client, which must not hold the write lock of concurrent imports.
+    #The backup stays pending until finish(), so partially linked rows are never used. Returns the number of positions
+    def linkMany(self,runs):
+        cnt = 0
+        chunk = []
+        for pos,hash,count in runs:
+            if not hash:
+                raise Exception("Hash is not defined")
+            chunk.append((pos,DelibBlock.hashToInt(hash),self.id,count))
+            cnt += count
+            if len(chunk) >= self.LINK_BATCH:
+                self.data._DBLinkBackupRuns(chunk)
+                self.data._DBCommit()
+                chunk = []
+        if chunk:
+            self.data._DBLinkBackupRuns(chunk)
+        self.data._DBCommit()
+        return cnt
+
+    #Groups hashes in position order into runs of consecutive identical hashes: (pos,hash,count). Positions start at 1
+    @staticmethod
+    def runLength(hashes):
+        run_pos,run_hash,run_count = 1,None,0
+        for hash in hashes:
+            if hash == run_hash:
+                run_count += 1
+                continue
+            if run_count:
+                yield run_pos,run_hash,run_count
+            run_pos,run_hash,run_count = run_pos + run_count,hash,1
+        if run_count:
+            yield run_pos,run_hash,run_count
+
+    #Links all hashes in position order as configured by the datastore link mode. Returns the number of positions
+    def linkHashes(self,hashes):
+        if self.data.getLinkMode() == self.data.LINK_MAP:
+            return self.linkMap(hashes)
+        #Consecutive identical hashes are linked as one run, runs are inserted in chunks
+        self.data.setBulkMode(True)
+        try:
+            return self.linkMany(DelibBackup.runLength(hashes))
+        finally:
+            self.data.setBulkMode(False)
+
+    #Links all hashes in position order into the backup's block map file. Returns the number of positions
+    def linkMap(self,hashes):
+        writer = DelibBlockMapWriter(self.data.getBlockMapPath(self.id))
+        try:
+            for hash in hashes:
+                if not hash:
+                    raise Exception("Hash is not defined")
+                writer.append(hash)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.close()
 
+##
+## Restore
+##
+## DelibRestoreIterator returns the blocks of a backup in position order. With workers > 1, a pool of threads
+## reads and decompresses the blocks of the next runs within a bounded read-ahead window while the caller
+## consumes the current one. lz4 releases the GIL, so worker threads scale with cores.
+##
 class DelibRestore:
 
-    def __init__(self,data,host,name):
+    QUEUE_PER_WORKER = 4        #Default read-ahead window in runs per worker
+
+    def __init__(self,data,host,name,workers=1,readahead=None):
         self.data = data
         self.name = name
         self.host = host
-        backup_id = self.data._DBGetBackupId(host,name)
-        self.db_blocks = self.data._DBGetBackupBlocks(backup_id)
+        self.workers = workers
+        self.readahead = readahead or workers * self.QUEUE_PER_WORKER
+        self.backup_id = self.data._DBGetBackupId(host,name)
+        self.iterators = []
+        self.blockmap = self.data.getBlockMap(self.backup_id)
+        if self.blockmap:
+            self.block_count = len(self.blockmap)
+        else:
+            #Rows are streamed by runs(), only the count is queried upfront
+            self.block_count = self.data._DBGetBackupBlockCount(self.backup_id)
+
+    #Number of positions in the backup
+    def getBlockCount(self):
+        return self.block_count
+
+    #Byte ranges (start,end) of position ranges (pos,count) given in ascending order. The sizes of all preceding
+    #blocks are summed up, as blocks of content-defined chunking vary in size
+    def getByteRanges(self,ranges):
+        byte_ranges = []
+        ranges = collections.deque(ranges)
+        pos,offset = 1,0
+        max_size = self.data.getMaxBlocksize()
+        for hash,row,count in self.runs():
+            if not ranges:
+                break
+            size = row["size"] if row is not None else max_size
+            while ranges and ranges[0][0] < pos + count:
+                first,cnt = ranges[0]
+                #A range may start and end within a run
+                start = offset + (max(first,pos) - pos) * size
+                end = offset + (min(first + cnt,pos + count) - pos) * size
+                if byte_ranges and byte_ranges[-1][1] == start:
+                    start = byte_ranges.pop()[0]
+                byte_ranges.append((start,end))
+                if first + cnt > pos + count:
+                    ranges[0] = (pos + count,first + cnt - pos - count)
+                    break
+                ranges.popleft()
+            pos += count
+            offset += count * size
+        return byte_ranges
+
+    #Runs of the backup as (hash,block row,count). The row is None for the zero block
+    def runs(self):
+        zero_hash = self.data.getZeroHash()
+        if self.blockmap:
+            for value,count in self.blockmap.runs():
+                hash = DelibBlock.intToHash(value)
+                yield hash,(None if hash == zero_hash else self.data._DBGetBlock(hash)),count
+        else:
+            for row in self.data._DBGetBackupBlocks(self.backup_id):
+                hash = DelibBlock.intToHash(row["block"])
+                yield hash,(None if hash == zero_hash else row),row["count"]
 
     def __iter__(self):
-        return DelibRestoreIterator(self)
+        iterator = DelibRestoreIterator(self)
+        self.iterators.append(iterator)
+        return iterator
+
+    #Stops the read-ahead of all iterators and unmaps the block map
+    def close(self):
+        for iterator in self.iterators:
+            iterator.close()
+        self.iterators = []
+        if self.blockmap:
+            self.blockmap.close()
+            self.blockmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
 
 class DelibRestoreIterator:
 
     def __init__(self,restore):
         self.restore = restore
-        self._index = 0
-        self._lastid = len(self.restore.db_blocks)
+        self._runs = restore.runs()
+        self._window = collections.deque()     #[block or future, count] of scheduled runs in position order
+        self._hash = None                       #Hash of the last scheduled run
+        self._remaining = 0
+        self._block = None
+        self._zero = None
+        self._cache = restore.data.getBlockCache()
+        if restore.workers > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=restore.workers)
+        else:
+            self.pool = None
+
+    def __iter__(self):
+        return self
 
     def __next__(self):
-        if self._index >= self._lastid:
-            raise StopIteration
-        row = self.restore.db_blocks[self._index]
-        path = self.restore.data.dir + "/blocks/" + row["filename"]
-        self._index += 1
-        is_compressed = bool(len(row["compressed"]))
-        return DelibBlock.fromFile(path,compressed=is_compressed)
+        #The pool is shut down at the end and on errors, e.g. a block that cannot be read
+        try:
+            while self._remaining == 0:
+                self._fill()
+                if not self._window:
+                    raise StopIteration
+                block,count = self._window.popleft()
+                if isinstance(block,concurrent.futures.Future):
+                    block = block.result()
+                self._block = block
+                self._remaining = count
+        except BaseException:
+            self.close()
+            raise
+        self._remaining -= 1
+        return self._block
+
+    #Also stops the runs of the block map, which holds a view of it
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=True,cancel_futures=True)
+            self.pool = None
+        self._runs.close()
+        self._window.clear()
+
+    #Schedules runs until the read-ahead window is full. Without workers, blocks are loaded one run at a time
+    def _fill(self):
+        limit = self.restore.readahead if self.pool else 1
+        while len(self._window) < limit:
+            try:
+                hash,row,count = next(self._runs)
+            except StopIteration:
+                return
+            #Repeated hashes reuse the last block
+            if hash == self._hash:
+                if self._window:
+                    self._window[-1][1] += count
+                else:
+                    self._window.append([self._block,count])
+                continue
+            self._hash = hash
+            if row is None:
+                #Zero block fast path: no block file access
+                if self._zero is None:
+                    self._zero = DelibBlock.zero(self.restore.data.getMaxBlocksize(),hash)
+                self._window.append([self._zero,count])
+            else:
+                block = self._cache.get(hash) if self._cache else None
+                if block is not None:
+                    self._window.append([block,count])
+                elif self.pool:
+                    self._window.append([self.pool.submit(self._load,hash,row),count])
+                else:
+                    self._window.append([self._load(hash,row),count])
+
+    #Worker stage: no database access allowed here
+    def _load(self,hash,row):
+        block = self.restore.data.readBlock(row)
+        if self._cache:
+            self._cache.put(block)
+        return block
 
 
 
@@ -138,54 +1059,525 @@ class DelibDataDir:
     STATE_DELETED = "deleted"       #Backup has been deleted. Cleanup has not necessarily been run yet!
 
     NAME_DB = "db.sqlite3"
+    NAME_MAPS = "maps"
+    NAME_PACKS = "packs"
+    NAME_LOCK = "inflight.lock"
+    NAME_CACHE = "cache"
+
+    BUSY_TIMEOUT = 300              #Seconds a connection waits for the write lock of another import
+    BUSY_RETRIES = 3                #Retries of a write transaction still locked after BUSY_TIMEOUT
+
+    LINK_DB = "db"                  #Backup positions are stored as backup_blocks rows
+    LINK_MAP = "map"                #Backup positions are stored as block map file per backup
+
+    STORAGE_LOOSE = "loose"         #New blocks are stored as one file per block in blocks/
+    STORAGE_PACK = "pack"           #New blocks are appended to packfiles in packs/
+
+    FANOUT_MAX = 2                  #Folder levels of 2 hash characters each for block files in blocks/
+
+    CODEC_DEFAULT = DelibCodec.LZ4  #Codec spec of new blocks, see DelibCodec.parse()
+
+    CHUNKING_FIXED = "fixed"        #Backups are split into blocks of the blocksize
+    CHUNKING_CDC = "cdc"            #Backups are split into content-defined chunks of blocksize to MAX_FACTOR * blocksize
+
+    #Database schema version. Older datastores must be upgraded with depot-migrate.py
+    ## 1: hashes as hex TEXT
+    ## 2: hashes as signed 64bit INTEGER, blocks WITHOUT ROWID
+    ## 3: backup_blocks run length in column count
+    ## 4: backup_blocks index on (backup,pos)
+    ## 5: blocks location in packfiles in columns pack and pack_offset
+    ## 6: blocks time of last successful verify in column time_verified
+    ## 7: backup_blocks index on block
+    ## 8: blocks reference count in column refcount, backups counted in column refcounted, table reclaim
+    SCHEMA_VERSION = 8
 
-    def __init__(self,dir,create_blocksize=False):
+    RECLAIM_BATCH = 10000           #Blocks deleted per transaction by reclaim()
+
+    def __init__(self,dir,create_blocksize=False,allow_outdated=False):
         self.dir = dir
         self.settings = {}
+        self.packfds = {}
+        self.packlock = threading.Lock()
+        self.claims = set()         #Claimed hashes of inserted blocks, released by the next commit
+        self.held = set()           #Hashes claimed by this datastore
+        self.lockfd = None          #Lock file of claimHash()
         if create_blocksize:
             self._DBCreate(create_blocksize)
         else:
             self._DBOpen()
+            if self.getSchemaVersion() < self.SCHEMA_VERSION and not allow_outdated:
+                raise Exception("Datastore schema version {} is outdated, need {}. Upgrade it with depot-migrate.py".format(self.getSchemaVersion(),self.SCHEMA_VERSION))
+
+    def getSchemaVersion(self):
+        return int(self.settings.get("version",1))
+
+    #Upgrades the database schema in-place, one version at a time
+    def migrate(self):
+        while self.getSchemaVersion() < self.SCHEMA_VERSION:
+            version = self.getSchemaVersion() + 1
+            logging.info("Migrating datastore to schema version {}".format(version))
+            getattr(self,"_DBMigrateTo{}".format(version))()
+            self.settings["version"] = str(version)
+            logging.info("Done migrating datastore to schema version {}".format(version))
 
     def getBlocksize(self):
         return self.settings["blocksize"]
 
+    #Codec and level new blocks are compressed with as (name,level), see DelibCodec
+    def getCodec(self):
+        return DelibCodec.parse(self.settings.get("codec",self.CODEC_DEFAULT))
+
+    def setCodec(self,spec):
+        DelibCodec.parse(spec)
+        self._DBSetSetting("codec",spec)
+
+    #How backups are split into blocks, see CHUNKING_*
+    def getChunking(self):
+        return self.settings.get("chunking",self.CHUNKING_FIXED)
+
+    def setChunking(self,chunking):
+        if chunking not in (self.CHUNKING_FIXED,self.CHUNKING_CDC):
+            raise Exception("Unsupported chunking {}. Must be {} or {}".format(chunking,self.CHUNKING_FIXED,self.CHUNKING_CDC))
+        self._DBSetSetting("chunking",chunking)
+
+    #Largest block of the datastore. With content-defined chunking the blocksize is the minimum chunk size
+    def getMaxBlocksize(self):
+        if self.getChunking() == self.CHUNKING_CDC:
+            return int(self.getBlocksize()) * DelibChunker.MAX_FACTOR
+        return int(self.getBlocksize())
+
+    def getChunker(self):
+        return DelibChunker(int(self.getBlocksize()))
+
+    #Hash of an all-zero block of the largest blocksize
+    zero_hash = None
+    def getZeroHash(self):
+        if self.zero_hash is None:
+            self.zero_hash = xxhash.xxh64(bytes(self.getMaxBlocksize())).hexdigest()
+        return self.zero_hash
+
+    #How new backups are linked, see LINK_*
+    def getLinkMode(self):
+        return self.settings.get("linkmode",self.LINK_DB)
+
+    def setLinkMode(self,mode):
+        if mode not in (self.LINK_DB,self.LINK_MAP):
+            raise Exception("Unsupported link mode {}. Must be {} or {}".format(mode,self.LINK_DB,self.LINK_MAP))
+        self._DBSetSetting("linkmode",mode)
+
+    BULK_CACHE_SIZE = 256 * 1024    #SQLite page cache in KiB while bulk linking
+
+    #Tunes the connection for bulk writes: synchronous=NORMAL and a larger page cache. The database is always in
+    #WAL mode, so a crash may lose the last commits but never corrupts the database. Disabling restores the values
+    #the connection had before
+    bulk_pragmas = None     #(synchronous,cache_size) before bulk mode, None outside of it
+    def setBulkMode(self,enabled):
+        self.db.commit()
+        if enabled and self.bulk_pragmas is None:
+            self.bulk_pragmas = (self.cur.execute("PRAGMA synchronous").fetchone()[0],self.cur.execute("PRAGMA cache_size").fetchone()[0])
+            self.cur.execute("PRAGMA synchronous = NORMAL")
+            self.cur.execute("PRAGMA cache_size = -{}".format(self.BULK_CACHE_SIZE))
+        elif not enabled and self.bulk_pragmas is not None:
+            synchronous,cache_size = self.bulk_pragmas
+            self.bulk_pragmas = None
+            self.cur.execute("PRAGMA synchronous = {:d}".format(synchronous))
+            self.cur.execute("PRAGMA cache_size = {:d}".format(cache_size))
+
+    #Where new blocks are stored, see STORAGE_*
+    def getStorage(self):
+        return self.settings.get("storage",self.STORAGE_LOOSE)
+
+    def setStorage(self,storage):
+        if storage not in (self.STORAGE_LOOSE,self.STORAGE_PACK):
+            raise Exception("Unsupported storage {}. Must be {} or {}".format(storage,self.STORAGE_LOOSE,self.STORAGE_PACK))
+        self._DBSetSetting("storage",storage)
+
+    #Folder levels of block files in blocks/, see getBlockPath()
+    def getFanout(self):
+        return int(self.settings.get("fanout",0))
+
+    def setFanout(self,levels):
+        if levels not in range(0,self.FANOUT_MAX + 1):
+            raise Exception("Unsupported fan-out {}. Must be 0 to {}".format(levels,self.FANOUT_MAX))
+        self._DBSetSetting("fanout",levels)
+
+    #Path of a block file. With fan-out, block files are placed in folders named after the first hash characters:
+    #blocks/ab/cd/abcd….lz4 for 2 levels
+    def getBlockPath(self,filename,levels=None):
+        if levels is None:
+            levels = self.getFanout()
+        return "/".join([self.dir,"blocks"] + [filename[i*2:i*2+2] for i in range(levels)] + [filename])
+
+    #Path of an existing block file. Falls back to the other fan-out levels as files may still be moved by depot-fanout.py
+    def findBlockPath(self,filename):
+        for levels in [self.getFanout()] + [levels for levels in range(0,self.FANOUT_MAX + 1) if levels != self.getFanout()]:
+            path = self.getBlockPath(filename,levels)
+            if os.path.isfile(path):
+                return path
+        raise FileNotFoundError("Block file {} not found in {}/blocks".format(filename,self.dir))
+
+    def getBlockMapPath(self,backup_id):
+        path = self.dir + "/" + self.NAME_MAPS
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return "{}/{}.map".format(path,backup_id)
+
+    #Returns the DelibBlockMap of a backup or None if the backup is linked in the database
+    def getBlockMap(self,backup_id):
+        path = "{}/{}/{}.map".format(self.dir,self.NAME_MAPS,backup_id)
+        if not os.path.isfile(path):
+            return None
+        return DelibBlockMap(path)
+
+    #Backups with a block map file, optionally limited to the given states
+    def getBlockMapBackups(self,states=None):
+        backups = []
+        for row in self.db.execute("SELECT ROWID,* FROM backups"):
+            if states and row["state"] not in states:
+                continue
+            if os.path.isfile("{}/{}/{}.map".format(self.dir,self.NAME_MAPS,row["rowid"])):
+                backups.append(row)
+        return backups
+
+    ##
+    ## Reference counting
+    ##
+    ## blocks.refcount is the number of ready or broken backups using a block. A backup's blocks are counted
+    ## once when it is finished and released once when it is failed or deleted. Blocks dropping to zero are
+    ## queued in the reclaim table and deleted by reclaim(). New blocks are queued when inserted, so the blocks
+    ## of an import that fails before its backup is counted are deleted as well.
+    ##
+
+    #Counts the blocks of a completely linked backup. Returns False if already counted
+    def referenceBackup(self,backup_id):
+        return self._DBRefBackup(backup_id,1)
+
+    #Releases the blocks of a failed or deleted backup and queues unused ones for reclaim(). Returns False if not counted
+    def releaseBackup(self,backup_id):
+        return self._DBRefBackup(backup_id,-1)
+
+    #Marks a backup as deleted and releases its blocks. Returns False for a pending backup, its import still runs
+    def deleteBackup(self,backup_id):
+        self.cur.execute("UPDATE backups SET state = :state WHERE ROWID = :backup AND state != :pending",{ "state": self.STATE_DELETED, "backup": backup_id, "pending": self.STATE_PENDING })
+        self.db.commit()
+        if self.cur.rowcount <= 0:
+            return False
+        self.releaseBackup(backup_id)
+        return True
+
+    #Number of blocks and compressed bytes only used by this backup, i.e. freed by deleting it
+    def getBackupExclusiveSize(self,backup_id):
+        refcounted = self.cur.execute("SELECT refcounted FROM backups WHERE ROWID = :backup",{ "backup": backup_id }).fetchone()["refcounted"]
+        self._DBBackupRefs(backup_id)
+        row = self.cur.execute("SELECT COUNT(*),COALESCE(SUM(b.csize),0) FROM backup_refs r JOIN blocks b ON b.hash = r.hash WHERE b.refcount <= :refs",{ "refs": 1 if refcounted else 0 }).fetchone()
+        self.cur.execute("DROP TABLE backup_refs")
+        return row[0],row[1]
+
+    #Recomputes all reference counts from the ready and broken backups and queues unused blocks, e.g. to repair them
+    def recountReferences(self):
+        self.db.commit()
+        self.cur.execute("BEGIN")
+        self._DBRecount()
+        self.db.commit()
+
+    #Deletes queued blocks that are still unused in batches of one transaction each. The block files of a batch
+    #are removed by a pool of threads after its commit. Stops once a backup is pending, as the blocks of running
+    #imports are not counted yet. Returns the number of deleted blocks and block files
+    def reclaim(self,workers=1):
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        cnt_blocks = 0
+        cnt_files = 0
+        while True:
+            #Immediate: no backup may reference a batch between reading and deleting it
+            self.db.commit()
+            self.cur.execute("BEGIN IMMEDIATE")
+            if self.cur.execute("SELECT COUNT(ROWID) FROM backups WHERE state = :state",{ "state": self.STATE_PENDING }).fetchone()[0]:
+                self.db.commit()
+                logging.info("Stopped reclaiming blocks: a backup is pending")
+                break
+            rows = self.cur.execute("SELECT r.hash,b.filename,b.refcount FROM reclaim r LEFT JOIN blocks b ON b.hash = r.hash LIMIT :limit",{ "limit": self.RECLAIM_BATCH }).fetchall()
+            if not rows:
+                self.db.commit()
+                break
+            garbage = [row for row in rows if row["refcount"] is not None and row["refcount"] <= 0]
+            self.cur.executemany("DELETE FROM blocks WHERE hash = ?",((row["hash"],) for row in garbage))
+            self.cur.executemany("DELETE FROM reclaim WHERE hash = ?",((row["hash"],) for row in rows))
+            if garbage:
+                self._DBCountChange("reclaimed")
+            self.db.commit()
+            cnt_blocks += len(garbage)
+            #Blocks in packs leave unused space in their pack until depot-pack.py --compact
+            paths = [self.findBlockPath(row["filename"]) for row in garbage if row["filename"]]
+            for result in pool.map(self._removeFile,paths):
+                cnt_files += result
+        pool.shutdown()
+        return cnt_blocks,cnt_files
+
+    @staticmethod
+    def _removeFile(path):
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
     def addBlock(self,block,do_commit=True):
         if not isinstance(block,DelibBlock):
             raise TypeError("Must be DelibBlock, not {}".format(type(block)))
         #Skip existing hashes
-        if self._DBHashExists(block.getHash()):
+        if self.hashExists(block.getHash()):
             logging.debug("Skipping existing block {}".format(block.getHash()))
             return False
-        #Open file and verify system-wide hash lock
-        filename = block.getHash()+".lz4"
-        filepath = self.dir+"/blocks/"+filename
-        if os.path.exists(filepath):
-            raise Exception("Cannot create block file. File already exists: {}".format(filepath))
-        with open(filepath,"wb") as fp:
-            fcntl.lockf(fp,fcntl.LOCK_EX | fcntl.LOCK_NB)
-            #Write hash
-            block.writeFP(fp, compressed=True)
-            self._DBAddBlock(filename,block,do_commit=do_commit)
+        #Another import may be storing the same block. It may in turn wait for our uncommitted claims
+        claimed = self.claimHash(block.getHash())
+        if not claimed:
+            self._DBCommit()
+            claimed = self.claimHash(block.getHash(),wait=True)
+        if claimed and self._DBHashExists(block.getHash()):
+            self.releaseHash(block.getHash())
+            return False
+        location = self.writeBlock(block)
+        self.addBlockRows([self._DBBlockRow(location,block)],do_commit=do_commit)
         return True
 
+    #Inserts rows of _DBBlockRow() for already written blocks and keeps the hash index up-to-date
+    def addBlockRows(self,rows,do_commit=True):
+        #Claims of inserted blocks are released by the commit
+        self.claims.update(DelibBlock.intToHash(row["hash"]) for row in rows)
+        self._DBAddBlocks(rows,do_commit=do_commit)
+        if self.hashindex is not None:
+            for row in rows:
+                self.hashindex.addValue(row["hash"])
+
+    #Stores the block compressed with the datastore codec or the given one without touching the database.
+    #Returns its location columns for _DBBlockRow(). Safe to call from worker threads
+    def writeBlock(self,block,codec=None):
+        block.encode(*(codec or self.getCodec()))
+        if self.getStorage() == self.STORAGE_PACK:
+            pack,offset = self.getPackWriter().append(DelibBlock.hashToInt(block.getHash()),block.getCompressed())
+            return { "filename": None, "pack": pack, "pack_offset": offset }
+        filename = block.getHash()+DelibCodec.getExtension(block.getCodec())
+        filepath = self.getBlockPath(filename)
+        #Written to a temporary file and renamed, so a block file is always complete. A block file of the same hash
+        #has the same content and is replaced
+        tmppath = "{}.{}.{}.tmp".format(filepath,os.getpid(),threading.get_ident())
+        try:
+            with self._createBlockFile(tmppath) as fp:
+                block.writeFP(fp, compressed=True)
+            os.replace(tmppath,filepath)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        return { "filename": filename, "pack": None, "pack_offset": None }
+
+    #Opens a new block file for writing, creating its fan-out folder. depot-fanout.py removes empty folders of the
+    #old layout, so the folder may vanish between creating it and the file. A folder holding the file stays
+    def _createBlockFile(self,path):
+        while True:
+            try:
+                if self.getFanout():
+                    os.makedirs(os.path.dirname(path),exist_ok=True)
+                return open(path,"wb")
+            except FileNotFoundError:
+                if not self.getFanout():
+                    raise
+
+    ##
+    ## Concurrent imports
+    ##
+    ## Several imports may write into one datadir at once. A new hash is claimed before its block is written,
+    ## so two imports never write the same block. Claims are POSIX record locks on one byte of the lock file per
+    ## hash: they are released by _DBCommit() once the block row is visible to the other imports, or by the kernel
+    ## if the process dies.
+    ##
+
+    CLAIM_TIMEOUT = 60              #Seconds to wait for a claim held by another import
+
+    #Record locks belong to the process, so imports within one process (e.g. threads of depot-server.py) are
+    #coordinated by claimed. The lock file is opened once per process: closing any descriptor drops all its locks
+    claimcond = threading.Condition()
+    claimed = set()
+    claimfds = {}
+
+    #Claims a hash. Returns False if another import holds it. With wait, waits for the holder instead and
+    #returns False only after CLAIM_TIMEOUT
+    def claimHash(self,hash,wait=False):
+        deadline = time.monotonic() + self.CLAIM_TIMEOUT
+        with self.claimcond:
+            while hash in self.claimed:
+                if not wait or not self.claimcond.wait(deadline - time.monotonic()):
+                    return False
+            self.claimed.add(hash)
+            path = os.path.realpath(self.dir + "/" + self.NAME_LOCK)
+            if path not in self.claimfds:
+                self.claimfds[path] = os.open(path,os.O_RDWR | os.O_CREAT,0o644)
+            self.lockfd = self.claimfds[path]
+        while True:
+            try:
+                fcntl.lockf(self.lockfd,fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB,1,self._claimOffset(hash))
+                self.held.add(hash)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN,errno.EACCES,errno.EDEADLK):
+                    self._unclaim(hash)
+                    raise
+                if e.errno != errno.EDEADLK or time.monotonic() > deadline:
+                    self._unclaim(hash)
+                    return False
+            #Threads of two imports waiting for each other look like a deadlock to the kernel, although the
+            #waiting imports commit and release their claims first
+            time.sleep(0.01)
+
+    #Releases a claim whose block was not inserted, e.g. because another import stored it meanwhile
+    def releaseHash(self,hash):
+        if hash not in self.held:
+            return
+        self.held.discard(hash)
+        fcntl.lockf(self.lockfd,fcntl.LOCK_UN,1,self._claimOffset(hash))
+        self._unclaim(hash)
+
+    def _unclaim(self,hash):
+        with self.claimcond:
+            self.claimed.discard(hash)
+            self.claimcond.notify_all()
+
+    @staticmethod
+    def _claimOffset(hash):
+        return DelibBlock.hashToInt(hash) & 0x3fffffffffffffff
+
+    #Reads and decompresses the block of a blocks row from its block file or pack. Safe to call from worker threads
+    def readBlock(self,row):
+        if row["pack"] is not None:
+            raw = os.pread(self.getPackFD(row["pack"]),row["csize"],row["pack_offset"])
+            name = "pack {} offset {}".format(row["pack"],row["pack_offset"])
+            if len(raw) != row["csize"]:
+                raise Exception("Block in {} is truncated".format(name))
+            return DelibBlock.fromStored(raw,row["compressed"],name)
+        try:
+            return DelibBlock.fromFile(self.getBlockPath(row["filename"]),codec=row["compressed"])
+        except FileNotFoundError:
+            return DelibBlock.fromFile(self.findBlockPath(row["filename"]),codec=row["compressed"])
+
     def getBlockByHash(self,hash):
-        row_block = self._DBGetBlock(hash)
-        with open(self.dir+"/blocks/"+row_block["filename"]) as fp:
-            rawblock = fp.read()
-        if row_block["compressed"]:
-            block = DelibBlock.fromCompressed(rawblock,hash)
-        else:
-            block = DelibBlock(rawblock,hash)
+        cache = self.getBlockCache()
+        block = cache.get(hash) if cache else None
+        if block is not None:
+            return block
+        block = self.readBlock(self._DBGetBlock(hash))
+        if cache:
+            cache.put(block)
         return block
 
+    #Created once under packlock, as worker threads of DelibIngestPool write blocks. _DBCommit() syncs only this writer
+    packwriter = None
+    def getPackWriter(self):
+        with self.packlock:
+            if self.packwriter is None:
+                path = self.dir + "/" + self.NAME_PACKS
+                if not os.path.isdir(path):
+                    os.makedirs(path,exist_ok=True)
+                self.packwriter = DelibPackWriter(path)
+            return self.packwriter
+
+    #Read-only file descriptor of a pack for os.pread(), opened once
+    def getPackFD(self,pack):
+        with self.packlock:
+            fd = self.packfds.get(pack)
+            if fd is None:
+                fd = os.open("{}/{}/{}.pack".format(self.dir,self.NAME_PACKS,pack),os.O_RDONLY)
+                self.packfds[pack] = fd
+            return fd
+
+    #Shared cache of decompressed blocks, None if disabled with setBlockCacheSize(0)
+    BLOCK_CACHE_SIZE = 256 * 1024 * 1024    #Default byte budget
+    blockcache = None
+    def getBlockCache(self):
+        if self.blockcache is None and self.BLOCK_CACHE_SIZE > 0:
+            self.blockcache = DelibBlockCache(self.BLOCK_CACHE_SIZE)
+        return self.blockcache
+
+    def setBlockCacheSize(self,size):
+        self.BLOCK_CACHE_SIZE = size
+        self.blockcache = None
+
     def removeBlockByHash(self,hash):
         ## TODO: implement later
         pass
 
+    hashindex = None
+    hashindex_reclaimed = None
+    def getHashIndex(self):
+        #Loaded once on first use as not all tools need it
+        if self.hashindex is None:
+            logging.debug("Loading hash index")
+            self.hashindex_reclaimed = self._DBGetCounter("reclaimed")
+            self.hashindex = DelibHashIndex(self._DBHashValues())
+            logging.debug("Loaded hash index with {} hashes".format(len(self.hashindex)))
+        return self.hashindex
+
+    #Changes whenever blocks have been imported or deleted
+    def getBlocksVersion(self):
+        return "{}-{}".format(self._DBGetCounter("imported"),self._DBGetCounter("reclaimed"))
+
+    #Path of the hash list export in format (see DelibHashExport), rebuilt in the cache folder only if blocks have
+    #changed since the last export
+    def getHashExportPath(self,format,fp_rate=DelibHashExport.BLOOM_FP_RATE):
+        if format not in (DelibHashExport.FORMAT_LIST,DelibHashExport.FORMAT_BLOOM):
+            raise Exception("Unsupported hash list format {}. Must be {} or {}".format(format,DelibHashExport.FORMAT_LIST,DelibHashExport.FORMAT_BLOOM))
+        name = "hashes-{}".format(format) if format == DelibHashExport.FORMAT_LIST else "hashes-{}-{}".format(format,fp_rate)
+        folder = self.dir + "/" + self.NAME_CACHE
+        filename = "{}.{}".format(name,self.getBlocksVersion())
+        path = folder + "/" + filename
+        if os.path.exists(path):
+            return path
+        logging.info("Exporting hash list to {}".format(path))
+        os.makedirs(folder,exist_ok=True)
+        tmppath = "{}.{}.tmp".format(path,os.getpid())
+        with open(tmppath,"wb") as fp:
+            if format == DelibHashExport.FORMAT_BLOOM:
+                DelibHashExport.writeBloom(fp,self._DBHashValuesUnsigned(),self._DBBlockCount(),fp_rate)
+            else:
+                DelibHashExport.writeList(fp,self._DBHashValuesUnsigned())
+        os.replace(tmppath,path)
+        #Older exports are stale
+        for old in os.listdir(folder):
+            if old.startswith(name + ".") and old != filename and not old.endswith(".tmp"):
+                os.remove(folder + "/" + old)
+        return path
+
+    #ROWID of the last ready backup of a host, None if it has none
+    def getLastBackupId(self,host):
+        row = self.cur.execute("SELECT ROWID FROM backups WHERE host = :host AND state = :state ORDER BY time_created DESC, ROWID DESC LIMIT 1",{ "host": host, "state": self.STATE_READY }).fetchone()
+        return row["ROWID"] if row else None
+
+    #Distinct integer hashes of a backup, without those of backup since_id if given, in the order of their unsigned
+    #value. Returns the number of hashes and a generator of them
+    def getBackupHashValues(self,backup_id,since_id=None):
+        self._DBBackupRefs(backup_id,"export_refs")
+        if since_id is not None:
+            self._DBBackupRefs(since_id,"export_since")
+            self.cur.execute("DELETE FROM export_refs WHERE hash IN (SELECT hash FROM export_since)")
+            self.cur.execute("DROP TABLE export_since")
+        self.db.commit()
+        count = self.cur.execute("SELECT COUNT(*) FROM export_refs").fetchone()[0]
+        return count,self._DBExportRefValues()
+
+    def _DBExportRefValues(self):
+        for row in self.db.execute("SELECT hash FROM export_refs WHERE hash >= 0 ORDER BY hash ASC"):
+            yield row["hash"]
+        for row in self.db.execute("SELECT hash FROM export_refs WHERE hash < 0 ORDER BY hash ASC"):
+            yield row["hash"]
+        self.cur.execute("DROP TABLE export_refs")
+
+    #Drops the hash index if blocks have been deleted since it was loaded. For long-running processes
+    def refreshHashIndex(self):
+        if self.hashindex is not None and self._DBGetCounter("reclaimed") != self.hashindex_reclaimed:
+            logging.debug("Dropping hash index, blocks have been deleted")
+            self.hashindex = None
+
     def hashExists(self,hash):
-        #Proxy for self._DBHashExists()
-        return self._DBHashExists(hash)
+        return hash in self.getHashIndex()
 
 
     ##
@@ -193,26 +1585,39 @@ class DelibDataDir:
     ## Override for other database engines
     ##
 
-    def _DBAddBlock(self,filename,block,do_commit=True):
-        self.cur.execute("INSERT INTO blocks (hash,size,csize,compressed,filename,time_imported) VALUES (:hash,:size,:csize,:compressed,:filename,:time)", {
-            "hash": block.getHash(),
+    def _DBAddBlock(self,location,block,do_commit=True):
+        self._DBAddBlocks([self._DBBlockRow(location,block)],do_commit=do_commit)
+
+    def _DBAddBlocks(self,rows,do_commit=True):
+        #A hash stored by another import meanwhile keeps its row
+        self._DBRetry(self.cur.executemany,"INSERT OR IGNORE INTO blocks (hash,size,csize,compressed,filename,pack,pack_offset,time_imported) VALUES (:hash,:size,:csize,:compressed,:filename,:pack,:pack_offset,:time)", rows)
+        #Unused until a finished backup counts them, e.g. if the import fails
+        self.cur.executemany("INSERT OR IGNORE INTO reclaim(hash) VALUES (:hash)",rows)
+        self._DBCountChange("imported")
+        if do_commit:
+            self._DBCommit()
+
+    #Row for _DBAddBlocks(). Built without database access so worker threads can prepare it
+    def _DBBlockRow(self,location,block):
+        return {
+            "hash": DelibBlock.hashToInt(block.getHash()),
             "size": block.getSize(),
             "csize": block.getCompressedSize(),
-            "compressed": "lz4",
-            "filename": filename ,
+            "compressed": block.getCodec(),
+            "filename": location["filename"],
+            "pack": location["pack"],
+            "pack_offset": location["pack_offset"],
             "time": int(time.time())
-        })
-        if do_commit:
-            self._DBCommit()
+        }
 
     def _DBGetBlock(self,hash):
-        row = self.cur.execute("SELECT * FROM blocks WHERE hash = :hash",{ "hash": hash }).fetchone()
+        row = self.cur.execute("SELECT * FROM blocks WHERE hash = :hash",{ "hash": DelibBlock.hashToInt(hash) }).fetchone()
         if not row:
             raise Exception("No such block in database: {}".format(hash))
         return row
 
     def _DBCreateBackup(self,host,name,device,time_created):
-        self.cur.execute("INSERT INTO backups (name,host,device,time_created,time_imported,state) VALUES (:name,:host,:device,:time_created,:time_imported,:state)",{
+        self._DBRetry(self.cur.execute,"INSERT INTO backups (name,host,device,time_created,time_imported,state) VALUES (:name,:host,:device,:time_created,:time_imported,:state)",{
             "name": name,
             "host": host,
             "device": device,
@@ -223,21 +1628,23 @@ class DelibDataDir:
         self.db.commit()
         return self.cur.lastrowid
 
-    def _DBFinishBackup(self,host,name,size):
-        self._DBVerifyBackup(host=host,name=name)
-        self.cur.execute("UPDATE backups SET time_imported = :time_imported, state = :state, size = :size WHERE host = :host AND name = :name",{
-            "host": host,
-            "name": name,
+    #Returns False if the backup is no longer pending, e.g. failed by depot-clean.py
+    def _DBFinishBackup(self,backup,size):
+        self._DBVerifyBackup(backup)
+        self.cur.execute("UPDATE backups SET time_imported = :time_imported, state = :state, size = :size WHERE ROWID = :backup AND state = :pending",{
+            "backup": backup,
             "size": size,
             "time_imported": int(time.time()),
-            "state": self.STATE_READY
+            "state": self.STATE_READY,
+            "pending": self.STATE_PENDING
         })
         self.db.commit()
+        return self.cur.rowcount > 0
 
     #Check if:
     # - backup size corresponds to blocks * blocksize
     # - blocks are continous and start at 1
-    def _DBVerifyBackup(self,host,name):
+    def _DBVerifyBackup(self,backup):
         #TODO
         pass
 
@@ -246,36 +1653,134 @@ class DelibDataDir:
         list = []
         self.cur.execute("SELECT block FROM backup_blocks WHERE backup = :backup ORDER BY pos ASC", { "backup": backup })
         for row in self.cur:
-            list.append(row)
+            list.append(DelibBlock.intToHash(row["block"]))
         return list
 
+    #Block rows of a backup in position order as generator on a dedicated cursor
     def _DBGetBackupBlocks(self,backup):
-        list = []
-        return self.cur.execute("SELECT b.*,bb.pos FROM backup_blocks bb LEFT JOIN blocks b ON bb.block = b.hash ORDER BY bb.pos ASC").fetchall()
+        for row in self.db.execute("SELECT b.*,bb.pos,bb.block,bb.count FROM backup_blocks bb LEFT JOIN blocks b ON bb.block = b.hash WHERE bb.backup = :backup ORDER BY bb.pos ASC",{ "backup": backup }):
+            yield row
+
+    def _DBGetBackupBlockCount(self,backup):
+        return self.cur.execute("SELECT COALESCE(SUM(count),0) FROM backup_blocks WHERE backup = :backup",{ "backup": backup }).fetchone()[0]
 
     def _DBGetBackupId(self,host,name):
-        res = self.cur.execute("SELECT ROWID FROM backups WHERE host = :host AND name = :name",{ "host": host, "name": name }).fetchone()
-        if not res:
+        backup = self.findBackupId(host,name)
+        if backup is None:
             raise Exception("No backup with host {} and name {}".format(host,name))
-        return res["ROWID"]
+        return backup
 
-    def _DBLinkBackupHash(self,backup,hash,pos,do_commit=True):
-        self.cur.execute("INSERT INTO backup_blocks (pos,block,backup) VALUES ( :pos , :block , :backup )", { "pos": pos, "backup": backup, "block": hash })
+    #ROWID of a backup, None if there is none
+    def findBackupId(self,host,name):
+        res = self.cur.execute("SELECT ROWID FROM backups WHERE host = :host AND name = :name",{ "host": host, "name": name }).fetchone()
+        return res["ROWID"] if res else None
+
+    def _DBLinkBackupHash(self,backup,hash,pos,count=1,do_commit=True):
+        self.cur.execute("INSERT INTO backup_blocks (pos,block,backup,count) VALUES ( :pos , :block , :backup , :count )", { "pos": pos, "backup": backup, "block": DelibBlock.hashToInt(hash), "count": count })
         if do_commit:
             self._DBCommit()
 
+    #Rows of (pos,block,backup,count) in one executemany(). Does not commit
+    def _DBLinkBackupRuns(self,rows):
+        self._DBRetry(self.cur.executemany,"INSERT INTO backup_blocks (pos,block,backup,count) VALUES (?,?,?,?)",rows)
+
+    #Counters of block changes in settings: imported counts batches of inserted blocks, reclaimed counts
+    #reclaim() batches that deleted blocks
+    def _DBGetCounter(self,key):
+        row = self.cur.execute("SELECT value FROM settings WHERE key = :key",{ "key": key }).fetchone()
+        return int(row["value"]) if row else 0
+
+    #Runs inside the caller's transaction
+    def _DBCountChange(self,key):
+        self.cur.execute("UPDATE settings SET value = value + 1 WHERE key = :key",{ "key": key })
+        if self.cur.rowcount <= 0:
+            self.cur.execute("INSERT INTO settings(key,value) VALUES (:key,1)",{ "key": key })
+
     def _DBHashExists(self,myhash):
-        return ( self.cur.execute("SELECT COUNT(rowid) FROM blocks WHERE hash = :hash",{"hash": myhash}).fetchone()[0] > 0 )
+        return ( self.cur.execute("SELECT COUNT(*) FROM blocks WHERE hash = :hash",{"hash": DelibBlock.hashToInt(myhash)}).fetchone()[0] > 0 )
+
+    #Integer hashes in database order as generator on a dedicated cursor
+    def _DBHashValues(self):
+        for row in self.db.execute("SELECT hash FROM blocks ORDER BY hash ASC"):
+            yield row["hash"]
 
+    #Hex hashes in text order as generator
     def _DBHashList(self):
-        hashes = []
-        self.cur.execute("SELECT hash FROM blocks ORDER BY hash ASC")
-        for row in self.cur:
-            hashes.append(row["hash"])
-        return hashes
+        for value in self._DBHashValuesUnsigned():
+            yield DelibBlock.intToHash(value)
+
+    #Integer hashes in the order of their unsigned value (i.e. hex text order) as generator on a dedicated cursor
+    def _DBHashValuesUnsigned(self):
+        for row in self.db.execute("SELECT hash FROM blocks WHERE hash >= 0 ORDER BY hash ASC"):
+            yield row["hash"]
+        for row in self.db.execute("SELECT hash FROM blocks WHERE hash < 0 ORDER BY hash ASC"):
+            yield row["hash"]
+
+    def _DBBlockCount(self):
+        return self.cur.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
 
     def _DBCommit(self):
+        #Inserted rows must not point to pack contents lost by a crash
+        if self.packwriter:
+            self.packwriter.sync()
+        self.db.commit()
+        for hash in self.claims:
+            self.releaseHash(hash)
+        self.claims.clear()
+
+    #Runs a statement that starts a write transaction, retrying if other imports hold the write lock beyond
+    #BUSY_TIMEOUT. Statements within a transaction are not retried, the transaction would be incomplete
+    def _DBRetry(self,func,*args):
+        retries = 0 if self.db.in_transaction else self.BUSY_RETRIES
+        while True:
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                if retries <= 0 or "locked" not in str(e):
+                    raise
+                retries -= 1
+                logging.warning("Database is locked by other imports, retrying")
+                self.db.rollback()
+
+    #Distinct hashes of a backup from its block map or backup_blocks (through its index on backup,pos) in temp table
+    #backup_refs or the given one
+    def _DBBackupRefs(self,backup,table="backup_refs"):
+        self.cur.execute("DROP TABLE IF EXISTS temp.{}".format(table))
+        self.cur.execute("CREATE TEMP TABLE {}(hash INTEGER PRIMARY KEY) WITHOUT ROWID".format(table))
+        blockmap = self.getBlockMap(backup)
+        if blockmap:
+            self.cur.executemany("INSERT OR IGNORE INTO {}(hash) VALUES (?)".format(table),((value,) for value in blockmap.values()))
+            blockmap.close()
+        else:
+            self.cur.execute("INSERT OR IGNORE INTO {}(hash) SELECT block FROM backup_blocks WHERE backup = :backup".format(table),{ "backup": backup })
+
+    #Adds delta to the refcount of each block of a backup once, in one transaction
+    def _DBRefBackup(self,backup,delta):
+        self.db.commit()
+        self.cur.execute("BEGIN IMMEDIATE")
+        refcounted = self.cur.execute("SELECT refcounted FROM backups WHERE ROWID = :backup",{ "backup": backup }).fetchone()["refcounted"]
+        if bool(refcounted) == (delta > 0):
+            self.db.commit()
+            return False
+        self._DBBackupRefs(backup)
+        self.cur.execute("UPDATE blocks SET refcount = refcount + :delta WHERE hash IN (SELECT hash FROM backup_refs)",{ "delta": delta })
+        if delta < 0:
+            self.cur.execute("INSERT OR IGNORE INTO reclaim(hash) SELECT b.hash FROM backup_refs r JOIN blocks b ON b.hash = r.hash WHERE b.refcount <= 0")
+        self.cur.execute("UPDATE backups SET refcounted = :refcounted WHERE ROWID = :backup",{ "refcounted": int(delta > 0), "backup": backup })
+        self.cur.execute("DROP TABLE backup_refs")
         self.db.commit()
+        return True
+
+    #Reference counts from scratch. Runs inside the caller's transaction
+    def _DBRecount(self):
+        self.cur.execute("UPDATE blocks SET refcount = 0")
+        self.cur.execute("UPDATE backups SET refcounted = 0")
+        for backup in self.cur.execute("SELECT ROWID FROM backups WHERE state IN ('ready','broken')").fetchall():
+            self._DBBackupRefs(backup["rowid"])
+            self.cur.execute("UPDATE blocks SET refcount = refcount + 1 WHERE hash IN (SELECT hash FROM backup_refs)")
+            self.cur.execute("UPDATE backups SET refcounted = 1 WHERE ROWID = :backup",{ "backup": backup["rowid"] })
+            self.cur.execute("DROP TABLE backup_refs")
+        self.cur.execute("INSERT OR IGNORE INTO reclaim(hash) SELECT hash FROM blocks WHERE refcount <= 0")
 
 
     def _DBOpen(self):
@@ -283,42 +1788,259 @@ class DelibDataDir:
         #Pre-run Sanity check
         if not os.path.isfile(db_path):
             raise Exception("Cannot open datastore: does not exist in {}".format(db_path))
-        #Open/Create database
-        self.db = sqlite3.connect(db_path)
+        #Open/Create database. Readers never block imports in WAL mode, imports wait for each other's write lock
+        self.db = sqlite3.connect(db_path,timeout=self.BUSY_TIMEOUT)
         self.db.row_factory = sqlite3.Row
         #self.db.set_trace_callback(logging.debug) #DEBUG DB
         self.cur = self.db.cursor()
+        self.cur.execute("PRAGMA journal_mode = WAL")
         #Load settings
         for row in self.db.execute("SELECT key,value FROM settings"):
             self.settings[row["key"]] = row["value"]
 
+    def _DBSetSetting(self,key,value):
+        self.cur.execute("DELETE FROM settings WHERE key = :key",{ "key": key })
+        self.cur.execute("INSERT INTO settings(key,value) VALUES (:key,:value)",{ "key": key, "value": value })
+        self.db.commit()
+        self.settings[key] = str(value)
+
     def _DBCreate(self,blocksize):
         db_path = self.dir+"/"+self.NAME_DB
         #Pre-run Sanity check
         if os.path.isfile(db_path):
             raise Exception("Cannot create datastore: already exists in {}".format(db_path))
         #Open/Create database
-        self.db = sqlite3.connect(db_path)
+        self.db = sqlite3.connect(db_path,timeout=self.BUSY_TIMEOUT)
         self.db.row_factory = sqlite3.Row
         self.cur = self.db.cursor()
+        self.cur.execute("PRAGMA journal_mode = WAL")
         #Create
         logging.info("Creating database")
         logging.debug("Creating table settings")
         self.cur.execute("CREATE TABLE settings(key TEXT, value TEXT)")
         #Blocks
         logging.debug("Creating table blocks")
-        self.cur.execute("CREATE TABLE blocks(hash TEXT PRIMARY KEY ,size INTEGER,csize INTEGER, compressed TEXT, filename TEXT, time_imported INTEGER)")
+        self.cur.execute("CREATE TABLE blocks(hash INTEGER PRIMARY KEY ,size INTEGER,csize INTEGER, compressed TEXT, filename TEXT, time_imported INTEGER, pack INTEGER, pack_offset INTEGER, time_verified INTEGER, refcount INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
         #Backups
         logging.debug("Creating table backups")
-        self.cur.execute("CREATE TABLE backups(name TEXT, host TEXT, device TEXT, size INTEGER, time_created INTEGER, time_imported INTEGER, state TEXT CHECK( state IN ('pending','ready','failed','broken','deleted') ), UNIQUE(host,name) ) ")
+        self.cur.execute("CREATE TABLE backups(name TEXT, host TEXT, device TEXT, size INTEGER, time_created INTEGER, time_imported INTEGER, state TEXT CHECK( state IN ('pending','ready','failed','broken','deleted') ), refcounted INTEGER NOT NULL DEFAULT 0, UNIQUE(host,name) ) ")
+        #Blocks queued for deletion by reclaim()
+        logging.debug("Creating table reclaim")
+        self.cur.execute("CREATE TABLE reclaim(hash INTEGER PRIMARY KEY) WITHOUT ROWID")
         #Backup->Blocks
         logging.debug("Creating table backup_blocks")
-        self.cur.execute("CREATE TABLE backup_blocks(pos INTEGER,  block NOT NULL REFERENCES blocks, backup NOT NULL REFERENCES backups)")
+        self.cur.execute("CREATE TABLE backup_blocks(pos INTEGER,  block INTEGER NOT NULL REFERENCES blocks, backup INTEGER NOT NULL REFERENCES backups, count INTEGER NOT NULL DEFAULT 1)")
+        self.cur.execute("CREATE INDEX backup_blocks_backup_pos ON backup_blocks(backup,pos)")
+        self.cur.execute("CREATE INDEX backup_blocks_block ON backup_blocks(block)")
         #Data and commit
         self.cur.execute("INSERT INTO settings(key,value) VALUES ('blocksize',{});".format(blocksize))
+        self.cur.execute("INSERT INTO settings(key,value) VALUES ('version',{});".format(self.SCHEMA_VERSION))
         self.db.commit()
+        self.settings["blocksize"] = str(blocksize)
+        self.settings["version"] = str(self.SCHEMA_VERSION)
         logging.info("Done creating database")
 
+    ##
+    ## Schema migrations, run by migrate() inside a single transaction each
+    ##
+
+    def _DBMigrateTo2(self):
+        #Hex TEXT hashes -> signed 64bit INTEGER, blocks WITHOUT ROWID
+        self.db.commit()
+        self.db.create_function("hashtoint",1,DelibBlock.hashToInt,deterministic=True)
+        self.cur.execute("BEGIN")
+        logging.debug("Converting table blocks")
+        self.cur.execute("CREATE TABLE blocks_new(hash INTEGER PRIMARY KEY ,size INTEGER,csize INTEGER, compressed TEXT, filename TEXT, time_imported INTEGER) WITHOUT ROWID")
+        self.cur.execute("INSERT INTO blocks_new (hash,size,csize,compressed,filename,time_imported) SELECT hashtoint(hash),size,csize,compressed,filename,time_imported FROM blocks")
+        self.cur.execute("DROP TABLE blocks")
+        self.cur.execute("ALTER TABLE blocks_new RENAME TO blocks")
+        logging.debug("Converting table backup_blocks")
+        self.cur.execute("CREATE TABLE backup_blocks_new(pos INTEGER,  block INTEGER NOT NULL REFERENCES blocks, backup INTEGER NOT NULL REFERENCES backups)")
+        self.cur.execute("INSERT INTO backup_blocks_new (pos,block,backup) SELECT pos,hashtoint(block),backup FROM backup_blocks ORDER BY ROWID ASC")
+        self.cur.execute("DROP TABLE backup_blocks")
+        self.cur.execute("ALTER TABLE backup_blocks_new RENAME TO backup_blocks")
+        self.cur.execute("INSERT INTO settings(key,value) VALUES ('version',2)")
+        self.db.commit()
+        #Give the freed pages back to the filesystem
+        logging.debug("Compacting database")
+        self.db.execute("VACUUM")
+
+    def _DBMigrateTo3(self):
+        #Run length of consecutive identical hashes. Existing rows are runs of 1
+        self.db.commit()
+        self.cur.execute("BEGIN")
+        self.cur.execute("ALTER TABLE backup_blocks ADD COLUMN count INTEGER NOT NULL DEFAULT 1")
+        self.cur.execute("UPDATE settings SET value = 3 WHERE key = 'version'")
+        self.db.commit()
+
+    def _DBMigrateTo4(self):
+        #Restores read the rows of one backup in position order
+        self.db.commit()
+        self.cur.execute("BEGIN")
+        logging.debug("Creating index backup_blocks_backup_pos")
+        self.cur.execute("CREATE INDEX backup_blocks_backup_pos ON backup_blocks(backup,pos)")
+        self.cur.execute("UPDATE settings SET value = 4 WHERE key = 'version'")
+        self.db.commit()
+
+    def _DBMigrateTo5(self):
+        #Location of blocks stored in packfiles. Existing blocks stay block files
+        self.db.commit()
+        self.cur.execute("BEGIN")
+        self.cur.execute("ALTER TABLE blocks ADD COLUMN pack INTEGER")
+        self.cur.execute("ALTER TABLE blocks ADD COLUMN pack_offset INTEGER")
+        self.cur.execute("UPDATE settings SET value = 5 WHERE key = 'version'")
+        self.db.commit()
+
+    def _DBMigrateTo6(self):
+        #Incremental and resumable verify
+        self.db.commit()
+        self.cur.execute("BEGIN")
+        self.cur.execute("ALTER TABLE blocks ADD COLUMN time_verified INTEGER")
+        self.cur.execute("UPDATE settings SET value = 6 WHERE key = 'version'")
+        self.db.commit()
+
+    def _DBMigrateTo7(self):
+        #Finds the backups using a block
+        self.db.commit()
+        self.cur.execute("BEGIN")
+        logging.debug("Creating index backup_blocks_block")
+        self.cur.execute("CREATE INDEX backup_blocks_block ON backup_blocks(block)")
+        self.cur.execute("UPDATE settings SET value = 7 WHERE key = 'version'")
+        self.db.commit()
+
+    def _DBMigrateTo8(self):
+        #Reference counts, counted from the existing backups
+        self.db.commit()
+        self.cur.execute("BEGIN")
+        self.cur.execute("ALTER TABLE blocks ADD COLUMN refcount INTEGER NOT NULL DEFAULT 0")
+        self.cur.execute("ALTER TABLE backups ADD COLUMN refcounted INTEGER NOT NULL DEFAULT 0")
+        self.cur.execute("CREATE TABLE reclaim(hash INTEGER PRIMARY KEY) WITHOUT ROWID")
+        logging.debug("Counting block references")
+        self._DBRecount()
+        self.cur.execute("UPDATE settings SET value = 8 WHERE key = 'version'")
+        self.db.commit()
+
+
+##
+## Parallel block ingest
+##
+## Stages: the caller reads blocks (e.g. from a TAR stream) and submits them into a bounded window,
+## worker threads decompress, verify, compress and write the block files and the caller's thread
+## is the single database writer inserting finished blocks in batches.
+## lz4 and xxhash release the GIL, so worker threads scale with cores.
+##
+class DelibIngestPool:
+
+    QUEUE_PER_WORKER = 4        #Blocks in flight per worker before submit() waits for the oldest
+    DB_BATCH = 1000             #Block rows per executemany()
+
+    def __init__(self,data,workers=1,do_commit=False):
+        self.data = data
+        self.do_commit = do_commit
+        self.workers = workers
+        self.inflight = set()
+        self.pending = set()
+        self.rows = []
+        self.cnt_blocks = 0
+        self.waiting = 0            #Submitted blocks claimed by another import
+        if workers > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            self.max_pending = workers * self.QUEUE_PER_WORKER
+        else:
+            self.pool = None
+
+    #Returns False if the hash is already being processed or has been stored by another import meanwhile
+    def submit(self,payload,client_hash,compressed,verify,name=None):
+        if client_hash in self.inflight:
+            return False
+        #Hashes claimed by another import are waited for by the worker
+        claimed = self.data.claimHash(client_hash)
+        if claimed and self.data._DBHashExists(client_hash):
+            self.data.releaseHash(client_hash)
+            return False
+        self.inflight.add(client_hash)
+        if not claimed:
+            self.waiting += 1
+        if not self.pool:
+            if not claimed:
+                #The other import may be waiting for our claims
+                self._insert()
+            self._store(self._process(payload,client_hash,compressed,verify,name,claimed))
+            return True
+        while len(self.pending) >= self.max_pending:
+            self._collect()
+        self.pending.add(self.pool.submit(self._process,payload,client_hash,compressed,verify,name,claimed))
+        return True
+
+    def isInflight(self,hash):
+        return hash in self.inflight
+
+    #Waits for all submitted blocks and inserts the remaining rows
+    def flush(self):
+        while self.pending:
+            self._collect()
+        self._insert()
+        self.inflight.clear()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.pool:
+                self.pool.shutdown(wait=True,cancel_futures=True)
+                self.pool = None
+
+    #Stores the blocks of all finished workers, waits for at least one. Rows are inserted in any order
+    def _collect(self):
+        done,_ = concurrent.futures.wait(self.pending,timeout=0,return_when=concurrent.futures.FIRST_COMPLETED)
+        if not done:
+            if self.waiting:
+                #A worker waits for another import, which may in turn be waiting for our claims
+                self._insert()
+            done,_ = concurrent.futures.wait(self.pending,return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            self.pending.remove(future)
+            self._store(future.result())
+
+    def _insert(self):
+        if self.rows:
+            self.data.addBlockRows(self.rows,do_commit=self.do_commit)
+            self.rows = []
+
+    def _store(self,result):
+        block,row = result
+        if row is None:
+            self.waiting -= 1
+            #Claimed after waiting for another import: only stored if that import did not
+            if self.data._DBHashExists(block.getHash()):
+                self.data.releaseHash(block.getHash())
+                return
+            row = self.data._DBBlockRow(self.data.writeBlock(block),block)
+        self.rows.append(row)
+        self.cnt_blocks += 1
+        if len(self.rows) >= self.DB_BATCH:
+            self._insert()
+
+    #Worker stage: no database access allowed here. Returns (block,row), row is None if the block was not claimed
+    def _process(self,payload,client_hash,compressed,verify,name,claimed=True):
+        if compressed:
+            #Client lz4 frames are stored verbatim
+            block = DelibBlock.fromFrame(payload,client_hash,verify=verify)
+            if client_hash != block.getHash():
+                raise Exception("Client hash {} differs from server hash {} for block {}".format(client_hash,block.getHash(),name))
+        elif verify:
+            block = DelibBlock(payload)
+            #Verify transfer with hash
+            if client_hash != block.getHash():
+                raise Exception("Client hash {} differs from server hash {} for block {}".format(client_hash,block.getHash(),name))
+        else:
+            block = DelibBlock(payload,client_hash)
+        if not claimed:
+            self.data.claimHash(client_hash,wait=True)
+            return block,None
+        location = self.data.writeBlock(block)
+        return block,self.data._DBBlockRow(location,block)
+
 
 class Delib:
 
@@ -380,9 +2102,31 @@ class Delib:
         return k,v
 
 
+    LIST_CHUNK_SIZE = 1024 * 1024   #Bytes of /backup/list read at once
+
+    #Hashes of the /backup/list member one at a time, read from the tar stream in chunks of LIST_CHUNK_SIZE.
+    #Must be consumed before the next tar member is read
+    def iterBackupList(self,tarinfo):
+        fp = self.fp.extractfile(tarinfo)
+        rest = b""
+        while True:
+            chunk = fp.read(self.LIST_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line.rstrip(b"\r").decode("utf-8")
+        if rest:
+            yield rest.rstrip(b"\r").decode("utf-8")
+
     def verifyTarHeaders(self):
+        if self.data.getChunking() == self.data.CHUNKING_CDC:
+            #Blocks of any size are stored, the zero block is only recognized at the largest blocksize
+            logging.debug("Accepting backup blocksize {} for content-defined chunking".format(self.tar["backup_blocksize"]))
+            return
         if self.tar["backup_blocksize"] != self.data.getBlocksize():
-            raise Exception("Tar blocksize {} differs from datastore blocksize {}".format(self.tar["backup_blocksize"],self.data.bs))
+            raise Exception("Tar blocksize {} differs from datastore blocksize {}".format(self.tar["backup_blocksize"],self.data.getBlocksize()))
         logging.debug("Verified backup blocksize {} ok".format(self.tar["backup_blocksize"]))
 
 
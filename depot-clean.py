@@ -11,53 +11,99 @@ logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=LOGL
 
 class DepotClean(Delib):
 
-    VERSION = 2019.305 #Year.Yearday
+    VERSION = 2026.291 #Year.Yearday
 
-    def __init__(self,dir,fail_after):
+    BATCH = 10000       #Rows deleted per transaction, keeps the database lock short
+
+    def __init__(self,dir,fail_after,full=False,workers=4):
         logging.info("Datastore directory {}".format(dir))
         self.data = DelibDataDir(dir)
+        self.workers = workers
 
         #Mark old pending backups as failed
         logging.debug("Marking pending backups older than {}s as failed".format(fail_after))
         older_than = int(time.time()) - fail_after
         self.data.cur.execute("UPDATE backups SET state = 'failed' WHERE state = 'pending' AND time_imported < :olderthan",{ "olderthan": older_than })
-        logging.warn("Marked {} pending backups older than {} as failed".format(self.data.cur.rowcount,humanfriendly.format_timespan(fail_after)))
-
-        #Delete backup-block links where backup does not exist or has been removed
-        logging.debug("Removing backup-block reference for non-existant, failed, deleted backups")
-        self.data.cur.execute("DELETE FROM backup_blocks WHERE NOT EXISTS ( SELECT ROWID FROM backups WHERE ROWID = backup_blocks.backup AND state NOT IN ('failed','deleted'));")
-        logging.warn("Deleted {} backup-block references".format(self.data.cur.rowcount))
-
-        #Delete non-referenced blocks in database
-        logging.debug("Removing non-referenced block entries if there are no pending backups")
-        res=self.data.cur.execute("SELECT COUNT(ROWID) FROM backups WHERE state = 'pending'").fetchone()
-        if(res[0] == 0):
-            logging.info("Skipping removing non-referenced block entries: {} pending backups".format(res[0]))
+        self.data.db.commit()
+        logging.warning("Marked {} pending backups older than {} as failed".format(self.data.cur.rowcount,humanfriendly.format_timespan(fail_after)))
+
+        #Release the blocks of removed backups, then drop their references
+        removed = [row["rowid"] for row in self.data.db.execute("SELECT ROWID FROM backups WHERE state IN ('failed','deleted')")]
+        self._unlinkBackups(removed)
+        if full:
+            logging.debug("Removing backup-block references of non-existant backups")
+            self._deleteBatched("DELETE FROM backup_blocks WHERE ROWID IN (SELECT ROWID FROM backup_blocks WHERE backup NOT IN (SELECT ROWID FROM backups) LIMIT :limit)")
+            logging.debug("Recounting block references")
+            self.data.recountReferences()
+
+        #Delete non-referenced blocks
+        started = time.time()
+        res = self.data.cur.execute("SELECT COUNT(ROWID) FROM backups WHERE state = 'pending'").fetchone()
+        if res[0] > 0:
+            #Imports in progress may rely on blocks that are not linked yet, or not even inserted
+            logging.info("Skipping removing non-referenced blocks: {} pending backups".format(res[0]))
         else:
-            logging.info("Removing non-referenced block entries; no pending backups ")
-            self.data.cur.execute("DELETE FROM blocks WHERE NOT EXISTS ( SELECT hash FROM backup_blocks WHERE block = blocks.hash)")
-            logging.warn("Deleted {} block entries".format(self.data.cur.rowcount))
-
+            logging.info("Removing non-referenced block entries; no pending backups")
+            cnt_blocks,cnt_files = self.data.reclaim(workers=self.workers)
+            logging.warning("Deleted {} block entries and {} block files".format(cnt_blocks,cnt_files))
+
+            #Remove blocks on filesystem that are not in DB
+            if full:
+                self._deleteOrphans(started,fail_after)
+
+    #Releases the blocks of the given backups and removes their references
+    def _unlinkBackups(self,backups):
+        cnt_links = 0
+        cnt_maps = 0
+        for backup in backups:
+            self.data.releaseBackup(backup)
+            blockmap = self.data.getBlockMap(backup)
+            if blockmap:
+                blockmap.close()
+                os.remove(blockmap.path)
+                cnt_maps += 1
+                continue
+            cnt_links += self._deleteBatched("DELETE FROM backup_blocks WHERE ROWID IN (SELECT ROWID FROM backup_blocks WHERE backup = :backup LIMIT :limit)",{ "backup": backup })
+        logging.warning("Deleted {} backup-block references and {} block maps of failed and deleted backups".format(cnt_links,cnt_maps))
+
+    #Runs a DELETE limited by :limit until no rows are left. Returns the number of deleted rows
+    def _deleteBatched(self,query,params={}):
+        cnt = 0
+        while True:
+            self.data.cur.execute(query,dict(params,limit=self.BATCH))
+            self.data.db.commit()
+            if self.data.cur.rowcount <= 0:
+                return cnt
+            cnt += self.data.cur.rowcount
+
+    #Imports started after the given time write block files before inserting them, temporary files younger than
+    #fail_after may belong to a running import. Both are kept
+    def _deleteOrphans(self,started,fail_after):
         #Get all remaining blocks from database
         known_files = {}
-        self.data.cur.execute("SELECT filename FROM blocks")
+        self.data.cur.execute("SELECT filename FROM blocks WHERE filename IS NOT NULL")
         cnt_blocks = 0
         for row in self.data.cur:
             cnt_blocks += 1
             known_files[row["filename"]] = True
         logging.debug("Read {} block entries from database".format(cnt_blocks))
 
-        #Remove blocks on filesystem that are not in DB
         logging.debug("Removing blocks from disk without block entry in database")
-        path = self.data.dir + "blocks/"
+        path = self.data.dir + "/blocks/"
         cnt_deleted = 0
         for r, d, f in os.walk(path):
             for file in f:
-                if file not in known_files:
-                    cnt_deleted += 1
-                    logging.debug("Found orphaned block: {}".format(file))
-                    os.remove(path+file)
-        logging.warn("Deleted {} orphaned blocks from datadir".format(cnt_deleted))
+                if file in known_files:
+                    continue
+                try:
+                    mtime = os.stat(os.path.join(r,file)).st_mtime
+                except FileNotFoundError:
+                    continue
+                if mtime >= started or ( file.endswith(".tmp") and mtime >= started - fail_after ):
+                    continue
+                logging.debug("Found orphaned block: {}".format(file))
+                cnt_deleted += self.data._removeFile(os.path.join(r,file))
+        logging.warning("Deleted {} orphaned blocks from datadir".format(cnt_deleted))
 
 
 
@@ -68,6 +114,8 @@ def parse_arguments():
      parser = argparse.ArgumentParser()
      parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
      parser.add_argument("--fail-after",nargs=1,required=False,default=["1d"],help="Fail pending backups after (Default: 1d)")
+     parser.add_argument("--full",action="store_true",help="Recount all block references and remove block files without block entry")
+     parser.add_argument("--workers",nargs=1,required=False,default=[4],type=int,help="Threads removing block files (Default: 4)")
      args = parser.parse_args()
      return args
 
@@ -77,4 +125,4 @@ if __name__ == "__main__":
     args = parse_arguments()
     logging.info("Starting DepotClean()")
     fail_after = humanfriendly.parse_timespan(args.fail_after[0])
-    dedup = DepotClean(dir=args.dir[0],fail_after=fail_after)
+    dedup = DepotClean(dir=args.dir[0],fail_after=fail_after,full=args.full,workers=args.workers[0])
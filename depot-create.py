@@ -13,7 +13,7 @@ class DepotCreate(Delib):
 
     VERSION = 2019.300 #Year.Yearday
 
-    def __init__(self,dir,blocksize_human):
+    def __init__(self,dir,blocksize_human,link_mode=DelibDataDir.LINK_DB,storage=DelibDataDir.STORAGE_LOOSE,fanout=DelibDataDir.FANOUT_MAX,chunking=DelibDataDir.CHUNKING_FIXED,codec=DelibDataDir.CODEC_DEFAULT):
         self.bs = humanfriendly.parse_size(blocksize_human,binary=True)
 
         logging.info("Datastore blocksize {}".format(self.bs))
@@ -25,6 +25,16 @@ class DepotCreate(Delib):
             raise Exception("Datadir path is not empty: {}".format(dir))
         os.mkdir(dir+"/blocks")
         self.data = DelibDataDir(dir,self.bs)
+        self.data.setLinkMode(link_mode)
+        logging.info("Datastore link mode {}".format(link_mode))
+        self.data.setStorage(storage)
+        logging.info("Datastore block storage {}".format(storage))
+        self.data.setFanout(fanout)
+        logging.info("Datastore block folder fan-out {}".format(fanout))
+        self.data.setChunking(chunking)
+        logging.info("Datastore chunking {}".format(chunking))
+        self.data.setCodec(codec)
+        logging.info("Datastore block codec {}".format(codec))
 
 
 
@@ -32,6 +42,11 @@ def parse_arguments():
      parser = argparse.ArgumentParser()
      parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
      parser.add_argument("--bs",nargs=1,required=True,help="Human-readable blocksize B|KB|MB|GB|TB")
+     parser.add_argument("--link",nargs=1,required=False,default=[DelibDataDir.LINK_DB],help="Store backup positions as database rows or as block map file per backup. Options=db|map Default=db")
+     parser.add_argument("--storage",nargs=1,required=False,default=[DelibDataDir.STORAGE_LOOSE],help="Store new blocks as one file each or appended to packfiles. Options=loose|pack Default=loose")
+     parser.add_argument("--fanout",nargs=1,required=False,default=[DelibDataDir.FANOUT_MAX],type=int,help="Folder levels for block files in blocks/, named after 2 hash characters each. Options=0|1|2 Default=2")
+     parser.add_argument("--chunking",nargs=1,required=False,default=[DelibDataDir.CHUNKING_FIXED],help="Split raw streams into blocks of the blocksize or into content-defined chunks of 1 to 4 times the blocksize. Options=fixed|cdc Default=fixed")
+     parser.add_argument("--codec",nargs=1,required=False,default=[DelibDataDir.CODEC_DEFAULT],help="Compression of new blocks with optional level. Blocks that do not shrink are stored raw. Options=lz4|zstd[:LEVEL]|none Default=lz4")
      args = parser.parse_args()
      return args
 
@@ -40,4 +55,4 @@ if __name__ == "__main__":
     logging.debug("Called: __main__")
     args = parse_arguments()
     logging.info("Starting DepotCreate()")
-    dedup = DepotCreate(dir=args.dir[0],blocksize_human=args.bs[0])
+    dedup = DepotCreate(dir=args.dir[0],blocksize_human=args.bs[0],link_mode=args.link[0],storage=args.storage[0],fanout=args.fanout[0],chunking=args.chunking[0],codec=args.codec[0])
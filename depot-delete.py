@@ -0,0 +1,58 @@
+"""
+Depot-Delete - Deletes a backup and reclaims the blocks only it used
+"""
+
+import argparse,humanfriendly,logging,sys       #Helpers
+from delib import Delib,DelibDataDir    #Dedup-Server
+
+LOGLEVEL=logging.DEBUG
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+class DepotDelete(Delib):
+
+    VERSION = 2026.291 #Year.Yearday
+
+    def __init__(self,dir,host,name,dry_run=False,workers=4):
+        logging.info("Datastore directory {}".format(dir))
+        self.data = DelibDataDir(dir)
+
+        backup = self.data.findBackupId(host,name)
+        if backup is None:
+            logging.error("No backup {} of host {}".format(name,host))
+            sys.exit(1)
+        cnt_blocks,size = self.data.getBackupExclusiveSize(backup)
+        logging.info("Deleting backup {} of host {} frees {} blocks ({})".format(name,host,cnt_blocks,humanfriendly.format_size(size,binary=True)))
+        if dry_run:
+            return
+
+        #References and block maps are removed by depot-clean.py
+        if not self.data.deleteBackup(backup):
+            logging.error("Backup {} of host {} is pending. Wait for its import or fail it with depot-clean.py".format(name,host))
+            sys.exit(1)
+        res = self.data.cur.execute("SELECT COUNT(ROWID) FROM backups WHERE state = 'pending'").fetchone()
+        if res[0] > 0:
+            #Imports in progress may rely on blocks that are not linked yet
+            logging.info("Blocks are reclaimed by the next depot-clean.py: {} pending backups".format(res[0]))
+            return
+        cnt_blocks,cnt_files = self.data.reclaim(workers=workers)
+        logging.warning("Deleted {} block entries and {} block files".format(cnt_blocks,cnt_files))
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--host",nargs=1,required=True,help="Host of the backup")
+     parser.add_argument("--name",nargs=1,required=True,help="Name of the backup")
+     parser.add_argument("--dry-run",action="store_true",help="Only report the space freed by deleting the backup")
+     parser.add_argument("--workers",nargs=1,required=False,default=[4],type=int,help="Threads removing block files (Default: 4)")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotDelete()")
+    dedup = DepotDelete(dir=args.dir[0],host=args.host[0],name=args.name[0],dry_run=args.dry_run,workers=args.workers[0])
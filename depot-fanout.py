@@ -0,0 +1,59 @@
+"""
+Depot-Fanout - Moves block files into hash-prefix folders
+"""
+
+import argparse,logging,os       #Helpers
+from delib import Delib,DelibDataDir,DelibCodec    #Dedup-Server
+
+LOGLEVEL=logging.DEBUG
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+class DepotFanout(Delib):
+
+    VERSION = 2026.290 #Year.Yearday
+
+    def __init__(self,dir,levels):
+        logging.info("Datastore directory {}".format(dir))
+        self.data = DelibDataDir(dir)
+
+        #New block files go into the new layout right away. Readers find moved files through findBlockPath()
+        logging.info("Changing block folder fan-out from {} to {}".format(self.data.getFanout(),levels))
+        self.data.setFanout(levels)
+
+        path = self.data.dir + "/blocks"
+        cnt_moved = 0
+        for r, d, f in os.walk(path,topdown=False):
+            for file in f:
+                if not file.endswith(DelibCodec.getExtensions()):
+                    continue
+                target = self.data.getBlockPath(file)
+                if os.path.join(r,file) == target:
+                    continue
+                os.makedirs(os.path.dirname(target),exist_ok=True)
+                #Atomic, a block file is always in one of the layouts
+                os.rename(os.path.join(r,file),target)
+                cnt_moved += 1
+            #Remove folders of the old layout once empty. An import may write a new block into it meanwhile
+            if r != path and not os.listdir(r):
+                try:
+                    os.rmdir(r)
+                except OSError:
+                    logging.debug("Keeping folder {}, it is in use".format(r))
+        logging.info("Done moving {} block files".format(cnt_moved))
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--levels",nargs=1,required=False,default=[DelibDataDir.FANOUT_MAX],type=int,help="Folder levels named after 2 hash characters each. Options=0|1|2 Default=2")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotFanout()")
+    dedup = DepotFanout(dir=args.dir[0],levels=args.levels[0])
@@ -0,0 +1,120 @@
+"""
+Depot-Ingest-Raw - Imports a raw file or device stream from STDIN as backup, split into blocks of the datastore blocksize
+"""
+
+import argparse,array,humanfriendly,logging,time,concurrent.futures       #Helpers
+import xxhash                   #Dedup
+from delib import Delib,DelibBlock,DelibDataDir,DelibBackup    #Dedup-Server
+
+LOGLEVEL=logging.INFO
+logging.basicConfig(format='%(asctime)s [IngestRaw] %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+#Worker stage: hashes of the blocks of one slice of the read buffer
+def _hashBlocks(view,blocksize):
+    return [xxhash.xxh64(view[i:i+blocksize]).hexdigest() for i in range(0,len(view),blocksize)]
+
+#Worker stage: compresses a new block ahead of DelibDataDir.addBlock()
+def _compressBlock(block,codec):
+    block.encode(*codec)
+    return block
+
+
+class DepotIngestRaw(Delib):
+
+    VERSION = 2026.291 #Year.Yearday
+
+    READ_SIZE = 16 * 1024 * 1024    #Bytes read at once, rounded down to whole blocks
+
+    def __init__(self,dir,host,name,device="-",workers=4):
+        logging.info("Datastore directory {}".format(dir))
+        Delib.__init__(self,DelibDataDir(dir),host,name)
+        if self.data.getChunking() != self.data.CHUNKING_FIXED:
+            raise Exception("Datastore uses {} chunking. Import raw streams with depot-rechunk.py".format(self.data.getChunking()))
+        self.prepareStdin()
+        self.blocksize = int(self.data.getBlocksize())
+        self.workers = workers
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+        backup = DelibBackup(data=self.data,host=host,name=name,device=device,time_created=int(time.time()))
+        #One buffer is reused for all reads. Blocks are memoryview slices of it, only new blocks are copied
+        buf = bytearray(max(self.READ_SIZE // self.blocksize,1) * self.blocksize)
+        view = memoryview(buf)
+        values = array.array("q")
+        size = 0
+        cnt_new = 0
+        #New blocks are committed once per buffer, or earlier if a concurrent import waits for one of their claims
+        self.data.setBulkMode(True)
+        try:
+            while True:
+                length = self._readFull(view)
+                if not length:
+                    break
+                size += length
+                cnt_new += self._ingest(view[:length],values)
+        finally:
+            #Blocks stored before a failure are inserted as well, so they are reclaimed with the failed backup
+            self.data._DBCommit()
+            self.data.setBulkMode(False)
+            if self.pool:
+                self.pool.shutdown(wait=True)
+        logging.info("Read {} in {} blocks. Stored {} new blocks".format(humanfriendly.format_size(size,binary=True),len(values),cnt_new))
+
+        #All blocks are stored before the backup is linked
+        cnt = backup.linkHashes(DelibBlock.intToHash(value) for value in values)
+        logging.info("Linked {} positions".format(cnt))
+        backup.finish(size=size)
+        logging.info("Backup linked and finished.")
+
+    #Fills the buffer unless the stream ends. Pipes return short reads. Returns the number of bytes read
+    def _readFull(self,view):
+        length = 0
+        while length < len(view):
+            cnt = self.raw_in.readinto(view[length:])
+            if not cnt:
+                break
+            length += cnt
+        return length
+
+    #Hashes the blocks of the buffer in parallel and stores the new ones. Appends their hashes to values.
+    #Returns the number of stored blocks
+    def _ingest(self,view,values):
+        #Each worker hashes a contiguous slice of whole blocks
+        step = -(-len(view) // self.blocksize // self.workers) * self.blocksize
+        slices = [view[i:i+step] for i in range(0,len(view),step)]
+        if self.pool:
+            hashes = [hash for part in self.pool.map(_hashBlocks,slices,[self.blocksize] * len(slices)) for hash in part]
+        else:
+            hashes = _hashBlocks(view,self.blocksize)
+
+        new = {}
+        for i,hash in enumerate(hashes):
+            values.append(DelibBlock.hashToInt(hash))
+            if hash not in new and not self.data.hashExists(hash):
+                new[hash] = DelibBlock(bytes(view[i*self.blocksize:(i+1)*self.blocksize]),hash)
+        blocks = self.pool.map(_compressBlock,new.values(),[self.data.getCodec()] * len(new)) if self.pool else new.values()
+        cnt = 0
+        for block in blocks:
+            if self.data.addBlock(block,do_commit=False):
+                cnt += 1
+        self.data._DBCommit()
+        return cnt
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--host",nargs=1,required=True,help="Client hostname")
+     parser.add_argument("--name",nargs=1,required=True,help="Backup name")
+     parser.add_argument("--device",nargs=1,required=False,default=["-"],help="Device recorded for the backup (Default: -)")
+     parser.add_argument("--workers",nargs=1,required=False,default=[4],type=int,help="Threads hashing and compressing blocks (Default: 4)")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotIngestRaw()")
+    dedup = DepotIngestRaw(dir=args.dir[0],host=args.host[0],name=args.name[0],device=args.device[0],workers=args.workers[0])
@@ -2,8 +2,8 @@
 Depot-List-Hashes - Datastore hash list
 """
 
-import argparse,humanfriendly,logging,os       #Helpers
-from delib import Delib,DelibDataDir    #Dedup-Server
+import argparse,humanfriendly,logging,os,shutil       #Helpers
+from delib import Delib,DelibDataDir,DelibBlock,DelibHashExport    #Dedup-Server
 
 LOGLEVEL=logging.INFO
 logging.basicConfig(format='%(asctime)s [Hashes] %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
@@ -11,20 +11,71 @@ logging.basicConfig(format='%(asctime)s [Hashes] %(levelname)-8s %(message)s', l
 
 class DepotList(Delib):
 
-    VERSION = 2019.300 #Year.Yearday
+    VERSION = 2026.291 #Year.Yearday
 
-    def __init__(self,dir):
+    FORMAT_TEXT = "text"
+
+    def __init__(self,dir,format=FORMAT_TEXT,fp_rate=DelibHashExport.BLOOM_FP_RATE,host=None,name=None,since=None):
         logging.info("Datastore directory {}".format(dir))
         self.data = DelibDataDir(dir)
-        for hash in self.data._DBHashList():
-            print(hash)
+        if host:
+            self.listBackup(host,name,since,format,fp_rate)
+            return
+        if format == self.FORMAT_TEXT:
+            #Streamed from the database in text order, one hash per line
+            for hash in self.data._DBHashList():
+                print(hash)
+            return
+        #Binary exports are cached until blocks change
+        path = self.data.getHashExportPath(format,fp_rate)
+        logging.info("Sending {} ({})".format(path,humanfriendly.format_size(os.path.getsize(path),binary=True)))
+        self.prepareStdOut()
+        with open(path,"rb") as fp:
+            shutil.copyfileobj(fp,self.raw_out)
+        self.raw_out.flush()
+
+    #Hashes of one backup of a host, by default its last ready one. With since, only those not in that backup
+    def listBackup(self,host,name,since,format,fp_rate):
+        if name:
+            backup = self.data._DBGetBackupId(host,name)
+        else:
+            backup = self.data.getLastBackupId(host)
+            if backup is None:
+                raise Exception("No ready backup of host {}".format(host))
+        since_id = None
+        if since:
+            #The client's list must still be valid: blocks of a ready backup are kept
+            row = self.data.cur.execute("SELECT ROWID,state FROM backups WHERE host = :host AND name = :name",{ "host": host, "name": since }).fetchone()
+            if not row or row["state"] != self.data.STATE_READY:
+                raise Exception("Backup {} of host {} is not ready anymore, request the full list".format(since,host))
+            since_id = row["ROWID"]
+        row = self.data.cur.execute("SELECT name FROM backups WHERE ROWID = :backup",{ "backup": backup }).fetchone()
+        count,values = self.data.getBackupHashValues(backup,since_id)
+        logging.info("Sending {} hashes of backup {} of host {}{}".format(count,row["name"],host," not in backup {}".format(since) if since else ""))
+        if format == self.FORMAT_TEXT:
+            for value in values:
+                print(DelibBlock.intToHash(value))
+            return
+        self.prepareStdOut()
+        if format == DelibHashExport.FORMAT_BLOOM:
+            DelibHashExport.writeBloom(self.raw_out,values,count,fp_rate)
+        else:
+            DelibHashExport.writeList(self.raw_out,values)
+        self.raw_out.flush()
 
 
 
 def parse_arguments():
      parser = argparse.ArgumentParser()
      parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--format",nargs=1,required=False,default=[DepotList.FORMAT_TEXT],choices=[DepotList.FORMAT_TEXT,DelibHashExport.FORMAT_LIST,DelibHashExport.FORMAT_BLOOM],help="text: one hash per line, list: lz4 framed varint deltas, bloom: lz4 framed Bloom filter (Default: text)")
+     parser.add_argument("--host",nargs=1,required=False,default=[None],help="Only hashes of the last ready backup of this host")
+     parser.add_argument("--name",nargs=1,required=False,default=[None],help="Only hashes of this backup of --host instead of its last ready one")
+     parser.add_argument("--since",nargs=1,required=False,default=[None],help="Only hashes not in this ready backup of --host, whose list the client already has")
+     parser.add_argument("--fp-rate",nargs=1,required=False,default=[DelibHashExport.BLOOM_FP_RATE],type=float,help="False positive rate of the Bloom filter (Default: 0.01)")
      args = parser.parse_args()
+     if (args.name[0] or args.since[0]) and not args.host[0]:
+         parser.error("--name and --since require --host")
      return args
 
 
@@ -32,4 +83,4 @@ if __name__ == "__main__":
     logging.debug("Called: __main__")
     args = parse_arguments()
     logging.info("Starting DepotList()")
-    dedup = DepotList(dir=args.dir[0])
+    dedup = DepotList(dir=args.dir[0],format=args.format[0],fp_rate=args.fp_rate[0],host=args.host[0],name=args.name[0],since=args.since[0])
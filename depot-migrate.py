@@ -0,0 +1,39 @@
+"""
+Depot-Migrate - Datastore schema upgrade
+"""
+
+import argparse,logging       #Helpers
+from delib import Delib,DelibDataDir    #Dedup-Server
+
+LOGLEVEL=logging.DEBUG
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+class DepotMigrate(Delib):
+
+    VERSION = 2026.290 #Year.Yearday
+
+    def __init__(self,dir):
+        logging.info("Datastore directory {}".format(dir))
+        self.data = DelibDataDir(dir,allow_outdated=True)
+        if self.data.getSchemaVersion() >= self.data.SCHEMA_VERSION:
+            logging.info("Datastore schema version {} is up-to-date".format(self.data.getSchemaVersion()))
+            return
+        logging.info("Upgrading datastore schema version {} to {}".format(self.data.getSchemaVersion(),self.data.SCHEMA_VERSION))
+        self.data.migrate()
+        logging.info("Done migrating.")
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotMigrate()")
+    dedup = DepotMigrate(dir=args.dir[0])
@@ -0,0 +1,132 @@
+"""
+Depot-Pack - Converts block files into packfiles
+"""
+
+import argparse,logging,os       #Helpers
+from delib import Delib,DelibDataDir,DelibPackWriter    #Dedup-Server
+from tqdm import tqdm #Progress bar
+
+LOGLEVEL=logging.DEBUG
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+class DepotPack(Delib):
+
+    VERSION = 2026.290 #Year.Yearday
+
+    BATCH = 1000        #Blocks moved per transaction
+
+    def __init__(self,dir,compact=False,min_unused=0.5):
+        logging.info("Datastore directory {}".format(dir))
+        self.data = DelibDataDir(dir)
+        self.move()
+        if compact:
+            self.compact(min_unused)
+
+    def move(self):
+
+        #New blocks go into packs right away
+        self.data.setStorage(self.data.STORAGE_PACK)
+        writer = self.data.getPackWriter()
+
+        total = self.data.cur.execute("SELECT COUNT(*) FROM blocks WHERE pack IS NULL").fetchone()[0]
+        logging.info("Moving {} block files into packs".format(total))
+        progress = tqdm(total=total,unit="blocks",leave=False)
+        cnt_moved = 0
+        while True:
+            #Batches in filename order read the blocks folder sequentially
+            rows = self.data.cur.execute("SELECT hash,filename FROM blocks WHERE pack IS NULL ORDER BY filename ASC LIMIT :limit",{ "limit": self.BATCH }).fetchall()
+            if not rows:
+                break
+            updates = []
+            paths = []
+            for row in rows:
+                path = self.data.findBlockPath(row["filename"])
+                paths.append(path)
+                with open(path,"rb") as fp:
+                    pack,offset = writer.append(row["hash"],fp.read())
+                updates.append({ "hash": row["hash"], "pack": pack, "pack_offset": offset })
+            self.data.cur.executemany("UPDATE blocks SET pack = :pack, pack_offset = :pack_offset, filename = NULL WHERE hash = :hash",updates)
+            self.data._DBCommit()
+            #Block files are only removed once the database points to the packs
+            for path in paths:
+                os.remove(path)
+            cnt_moved += len(rows)
+            progress.update(len(rows))
+        writer.close()
+        progress.close()
+        logging.info("Done moving {} blocks into packs".format(cnt_moved))
+
+    #Rewrites the live blocks of packs with at least min_unused of their bytes left by removed or recompressed blocks
+    #into new packs and deletes the old ones. The last pack is never compacted, as writers continue it and its id must
+    #not be reused
+    def compact(self,min_unused):
+        path = self.data.dir + "/" + self.data.NAME_PACKS
+        ids = sorted(int(name[:-5]) for name in os.listdir(path) if name.endswith(".pack") and name[:-5].isdigit())[:-1]
+        live = { row["pack"]: row["size"] for row in self.data.cur.execute("SELECT pack,SUM(csize) + COUNT(*) * :record AS size FROM blocks WHERE pack IS NOT NULL GROUP BY pack",{ "record": DelibPackWriter.RECORD.size }) }
+        writer = self.data.getPackWriter()
+        holder = DelibPackWriter(path)
+        cnt_packs = 0
+        cnt_freed = 0
+        for id in ids:
+            size = os.path.getsize("{}/{}.pack".format(path,id)) - DelibPackWriter.HEADER.size
+            unused = size - live.get(id,0)
+            if size <= 0 or unused < size * min_unused:
+                continue
+            #No writer may append to the pack while its blocks are moved
+            if not holder.hold(id):
+                logging.info("Skipping pack {}: it is in use".format(id))
+                continue
+            try:
+                if self._compactPack(id,writer):
+                    os.close(self.data.packfds.pop(id))
+                    os.remove("{}/{}.pack".format(path,id))
+                    cnt_packs += 1
+                    cnt_freed += unused
+            finally:
+                holder.close()
+        writer.close()
+        logging.info("Done compacting {} packs, freed {} bytes".format(cnt_packs,cnt_freed))
+
+    #Moves the blocks of one pack to the writer. Returns True if no block references the pack any more
+    def _compactPack(self,id,writer):
+        fd = self.data.getPackFD(id)
+        first = 0
+        while True:
+            rows = self.data.cur.execute("SELECT hash,csize,pack_offset FROM blocks WHERE pack = :pack AND pack_offset >= :first ORDER BY pack_offset ASC LIMIT :limit",{ "pack": id, "first": first, "limit": self.BATCH }).fetchall()
+            if not rows:
+                break
+            first = rows[-1]["pack_offset"] + 1
+            updates = []
+            for row in rows:
+                pack,offset = writer.append(row["hash"],os.pread(fd,row["csize"],row["pack_offset"]))
+                updates.append({ "hash": row["hash"], "pack": pack, "pack_offset": offset, "old": id, "old_offset": row["pack_offset"] })
+            #Blocks recompressed meanwhile already live elsewhere
+            self.data.cur.executemany("UPDATE blocks SET pack = :pack, pack_offset = :pack_offset WHERE hash = :hash AND pack = :old AND pack_offset = :old_offset",updates)
+            self.data._DBCommit()
+        #Imports insert blocks after writing them, a pending one may still reference a pack it has left
+        self.data.cur.execute("BEGIN IMMEDIATE")
+        pending = self.data.cur.execute("SELECT COUNT(ROWID) FROM backups WHERE state = :state",{ "state": self.data.STATE_PENDING }).fetchone()[0]
+        used = self.data.cur.execute("SELECT COUNT(*) FROM blocks WHERE pack = :pack",{ "pack": id }).fetchone()[0]
+        self.data.db.commit()
+        if pending or used:
+            logging.info("Keeping pack {}: {}".format(id,"a backup is pending" if pending else "it is still referenced"))
+            return False
+        return True
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--compact",action="store_true",help="Also rewrite packs with unused space left by removed blocks")
+     parser.add_argument("--min-unused",nargs=1,required=False,default=[0.5],type=float,help="Fraction of unused bytes from which a pack is compacted (Default: 0.5)")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotPack()")
+    dedup = DepotPack(dir=args.dir[0],compact=args.compact,min_unused=args.min_unused[0])
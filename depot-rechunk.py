@@ -0,0 +1,64 @@
+"""
+Depot-Rechunk - Imports a raw stream from STDIN as backup, split into content-defined chunks
+"""
+
+import argparse,array,humanfriendly,logging,time       #Helpers
+import xxhash                   #Dedup
+from delib import Delib,DelibBlock,DelibDataDir,DelibBackup,DelibIngestPool    #Dedup-Server
+
+LOGLEVEL=logging.INFO
+logging.basicConfig(format='%(asctime)s [Rechunk] %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+class DepotRechunk(Delib):
+
+    VERSION = 2026.291 #Year.Yearday
+
+    def __init__(self,dir,host,name,device="-",workers=1):
+        logging.info("Datastore directory {}".format(dir))
+        Delib.__init__(self,DelibDataDir(dir),host,name)
+        if self.data.getChunking() != self.data.CHUNKING_CDC:
+            raise Exception("Datastore uses {} chunking. Create it with --chunking {}".format(self.data.getChunking(),self.data.CHUNKING_CDC))
+        self.prepareStdin()
+
+        backup = DelibBackup(data=self.data,host=host,name=name,device=device,time_created=int(time.time()))
+        #New chunks are compressed and written by the ingest pool while the stream is chunked
+        ingest = DelibIngestPool(self.data,workers=workers,do_commit=True)
+        values = array.array("q")
+        size = 0
+        #Blocks written before a failure are inserted as well, so they are reclaimed with the failed backup
+        try:
+            for chunk in self.data.getChunker().chunks(self.raw_in):
+                hash = xxhash.xxh64(chunk).hexdigest()
+                size += len(chunk)
+                if not ( ingest.isInflight(hash) or self.data.hashExists(hash) ):
+                    ingest.submit(chunk,hash,compressed=False,verify=False)
+                values.append(DelibBlock.hashToInt(hash))
+        finally:
+            ingest.close()
+        logging.info("Read {} in {} chunks. Stored {} new blocks".format(humanfriendly.format_size(size,binary=True),len(values),ingest.cnt_blocks))
+
+        #All chunks are stored before the backup is linked
+        cnt = backup.linkHashes(DelibBlock.intToHash(value) for value in values)
+        logging.info("Linked {} positions".format(cnt))
+        backup.finish(size=size)
+        logging.info("Backup linked and finished.")
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--host",nargs=1,required=True,help="Client hostname")
+     parser.add_argument("--name",nargs=1,required=True,help="Backup name")
+     parser.add_argument("--device",nargs=1,required=False,default=["-"],help="Device recorded for the backup (Default: -)")
+     parser.add_argument("--workers",nargs=1,required=False,default=[1],type=int,help="Threads compressing and writing new blocks (Default: 1)")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotRechunk()")
+    dedup = DepotRechunk(dir=args.dir[0],host=args.host[0],name=args.name[0],device=args.device[0],workers=args.workers[0])
@@ -0,0 +1,94 @@
+"""
+Depot-Recompress - Recompresses cold blocks with a denser codec in the background
+"""
+
+import argparse,humanfriendly,logging,os,time,concurrent.futures       #Helpers
+from delib import Delib,DelibDataDir,DelibCodec,DelibRateLimit    #Dedup-Server
+
+LOGLEVEL=logging.INFO
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
+
+
+class DepotRecompress(Delib):
+
+    VERSION = 2026.291 #Year.Yearday
+
+    BATCH = 1000        #Blocks replaced per transaction
+
+    def __init__(self,dir,codec,older_than=None,workers=1,max_rate=0):
+        logging.info("Datastore directory {}".format(dir))
+        self.data = DelibDataDir(dir)
+        self.codec = DelibCodec.parse(codec)
+        #Raw blocks did not shrink when they were stored and are kept raw
+        cutoff = int(time.time()) - (older_than or 0)
+        total = self.data.cur.execute("SELECT COUNT(*) FROM blocks WHERE compressed NOT IN (:codec,'') AND time_imported <= :cutoff",{ "codec": self.codec[0], "cutoff": cutoff }).fetchone()[0]
+        logging.info("Recompressing up to {} blocks with {}".format(total,codec))
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        limit = DelibRateLimit(max_rate)
+        cnt_blocks = 0
+        cnt_saved = 0
+        cnt_checked = 0
+        first = -(1 << 63)
+        while True:
+            #Batches in hash order, so blocks that do not shrink are not read again
+            rows = self.data.cur.execute("SELECT hash,size,csize,compressed,filename,pack,pack_offset FROM blocks WHERE compressed NOT IN (:codec,'') AND time_imported <= :cutoff AND hash >= :first ORDER BY hash ASC LIMIT :limit",{ "codec": self.codec[0], "cutoff": cutoff, "first": first, "limit": self.BATCH }).fetchall()
+            if not rows:
+                break
+            first = rows[-1]["hash"] + 1
+            limit.consume(sum(row["csize"] or 0 for row in rows))
+            results = pool.map(self._recompress,rows) if pool else map(self._recompress,rows)
+            updates = []
+            paths = []
+            for row,block,location in results:
+                if block is None:
+                    continue
+                updates.append(dict(location,hash=row["hash"],csize=block.getCompressedSize(),compressed=block.getCodec(),old=row["compressed"]))
+                cnt_saved += row["csize"] - block.getCompressedSize()
+                if row["filename"] and row["filename"] != location["filename"]:
+                    paths.append(self.data.findBlockPath(row["filename"]))
+            #Blocks changed meanwhile are left alone, their new copy is an orphan for depot-clean.py --full
+            self.data.cur.executemany("UPDATE blocks SET csize = :csize, compressed = :compressed, filename = :filename, pack = :pack, pack_offset = :pack_offset WHERE hash = :hash AND compressed = :old",updates)
+            self.data._DBCommit()
+            #Old block files are only removed once the database points to the new ones. Blocks in packs leave
+            #unused space in their pack until depot-pack.py --compact
+            for path in paths:
+                self.data._removeFile(path)
+            cnt_blocks += len(updates)
+            cnt_checked += len(rows)
+            logging.info("Recompressed {} of {} blocks".format(cnt_blocks,cnt_checked))
+            if first >= 1 << 63:
+                break
+        if pool:
+            pool.shutdown()
+        if self.data.packwriter:
+            self.data.packwriter.close()
+        logging.info("Done recompressing {} blocks, saved {}".format(cnt_blocks,humanfriendly.format_size(cnt_saved,binary=True)))
+
+    #Worker stage: no database access allowed here. Returns (row,block,location), block is None if it did not shrink
+    def _recompress(self,row):
+        block = self.data.readBlock(row)
+        block.encode(*self.codec)
+        if block.getCompressedSize() >= row["csize"]:
+            return row,None,None
+        return row,block,self.data.writeBlock(block,self.codec)
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--codec",nargs=1,required=True,help="Codec with optional level. Options=lz4|zstd[:LEVEL]|none")
+     parser.add_argument("--older-than",nargs=1,required=False,default=[None],help="Only recompress blocks imported longer ago than this timespan, e.g. 30d (Default: all blocks)")
+     parser.add_argument("--workers",nargs=1,required=False,default=[1],type=int,help="Threads reading, compressing and writing blocks (Default: 1)")
+     parser.add_argument("--max-rate",nargs=1,required=False,default=["0"],help="Maximum read rate of compressed blocks per second, 0 for unlimited. Human-readable B|KB|MB|GB (Default: 0)")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotRecompress()")
+    older_than = humanfriendly.parse_timespan(args.older_than[0]) if args.older_than[0] else None
+    dedup = DepotRecompress(dir=args.dir[0],codec=args.codec[0],older_than=older_than,workers=args.workers[0],max_rate=humanfriendly.parse_size(args.max_rate[0],binary=True))
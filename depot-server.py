@@ -0,0 +1,220 @@
+"""
+Depot-Server - Long-running datastore daemon for backup streams, hash lists and restores on a socket
+Protocol: the client sends one command line, followed by the Dedup-Tar for INGEST
+    INGEST <host> <name>    Imports a Dedup-Tar stream until EOF. Answers "OK <new blocks>" or "ERROR <message>"
+    HASHES [list|bloom [fp]] Streams the hash list of the datastore, one hash per line or in a binary format
+    RESTORE <host> <name>   Streams the raw image of a backup
+"""
+
+import argparse,asyncio,humanfriendly,logging,os,shutil,signal,threading,concurrent.futures       #Helpers
+from delib import Delib,DelibDataDir,DelibBlockCache,DelibRestore,DelibHashExport    #Dedup-Server
+from depot import Depot
+
+LOGLEVEL=logging.INFO
+#Replaces the configuration of the imported depot module
+logging.basicConfig(format='%(asctime)s [Server] %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S', force=True)
+
+
+##
+## Blocking file objects over asyncio streams for the request threads
+##
+class DepotStreamReader:
+
+    def __init__(self,reader,loop):
+        self.reader = reader
+        self.loop = loop
+
+    def read(self,size=-1):
+        return asyncio.run_coroutine_threadsafe(self.reader.read(size),self.loop).result()
+
+
+class DepotStreamWriter:
+
+    BUFFER_SIZE = 1024 * 1024   #Bytes collected before they are handed to the event loop
+
+    def __init__(self,writer,loop):
+        self.writer = writer
+        self.loop = loop
+        self.buffer = bytearray()
+
+    def write(self,data):
+        self.buffer += data
+        if len(self.buffer) >= self.BUFFER_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            asyncio.run_coroutine_threadsafe(self._send(data),self.loop).result()
+
+    async def _send(self,data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class DepotServer(Delib):
+
+    VERSION = 2026.291 #Year.Yearday
+
+    DRAIN_SIZE = 1024 * 1024    #Bytes read at once when discarding the rest of a stream
+
+    def __init__(self,dir,socket_path=None,listen=None,workers=8,ingest_workers=1,restore_workers=1,cache_size=None):
+        logging.info("Datastore directory {}".format(dir))
+        self.dir = dir
+        self.ingest_workers = ingest_workers
+        self.restore_workers = restore_workers
+        #Requests run in a pool of threads, each keeps its datastore open. Decompressed blocks are shared by all
+        self.local = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers,thread_name_prefix="request")
+        cache_size = DelibDataDir.BLOCK_CACHE_SIZE if cache_size is None else cache_size
+        self.blockcache = DelibBlockCache(cache_size) if cache_size > 0 else None
+        self.clients = set()
+        #One hash index for all request threads, loaded before accepting requests
+        self.hashindex = None
+        self.hashindexlock = threading.Lock()
+        self.shareHashIndex(DelibDataDir(self.dir))
+        try:
+            asyncio.run(self.serve(socket_path,listen))
+        finally:
+            self.pool.shutdown(wait=True)
+        logging.info("Server stopped")
+
+    #Datastore of the current request thread, opened on first use. SQLite connections are bound to their thread
+    def getData(self):
+        data = getattr(self.local,"data",None)
+        if data is None:
+            data = DelibDataDir(self.dir)
+            if self.blockcache is None:
+                data.setBlockCacheSize(0)
+            else:
+                data.blockcache = self.blockcache
+            self.shareHashIndex(data)
+            self.local.data = data
+        return data
+
+    #Hands the shared hash index to a datastore. It is reloaded once if blocks have been deleted since it was loaded.
+    #New blocks are added by the ingesting thread, set operations are atomic for the other threads
+    def shareHashIndex(self,data):
+        with self.hashindexlock:
+            if self.hashindex is None or data._DBGetCounter("reclaimed") != self.hashindex_reclaimed:
+                data.hashindex = None
+                self.hashindex = data.getHashIndex()
+                self.hashindex_reclaimed = data.hashindex_reclaimed
+                logging.info("Loaded hash index with {} hashes".format(len(self.hashindex)))
+            data.hashindex = self.hashindex
+            data.hashindex_reclaimed = self.hashindex_reclaimed
+
+    async def serve(self,socket_path,listen):
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle,path=socket_path)
+            os.chmod(socket_path,0o660)
+            logging.info("Listening on {}".format(socket_path))
+        else:
+            host,port = listen.rsplit(":",1)
+            server = await asyncio.start_server(self.handle,host=host or None,port=int(port))
+            logging.info("Listening on {}".format(listen))
+
+        #Stops accepting on SIGTERM/SIGINT and waits for running requests
+        stop = asyncio.get_running_loop().create_future()
+        for sig in (signal.SIGTERM,signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(sig,lambda: stop.done() or stop.set_result(None))
+        async with server:
+            await stop
+            logging.info("Stopping, waiting for {} requests".format(len(self.clients)))
+            server.close()
+            await asyncio.gather(*self.clients,return_exceptions=True)
+        if socket_path:
+            os.remove(socket_path)
+
+    async def handle(self,reader,writer):
+        task = asyncio.current_task()
+        self.clients.add(task)
+        loop = asyncio.get_running_loop()
+        try:
+            command = (await reader.readline()).decode("utf-8").split()
+            if not command:
+                return
+            logging.info("Request {}".format(" ".join(command)))
+            if command[0] == "INGEST" and len(command) == 3:
+                try:
+                    cnt = await loop.run_in_executor(self.pool,self.ingest,DepotStreamReader(reader,loop),command[1],command[2])
+                    writer.write("OK {}\n".format(cnt).encode("utf-8"))
+                except Exception as e:
+                    logging.exception("Ingest of {} {} failed".format(command[1],command[2]))
+                    writer.write("ERROR {}\n".format(e).encode("utf-8"))
+                #The rest of the stream is read, closing with unread input would reset the connection before the answer
+                while await reader.read(self.DRAIN_SIZE):
+                    pass
+            elif command[0] == "HASHES" and len(command) <= 3:
+                await loop.run_in_executor(self.pool,self.hashes,DepotStreamWriter(writer,loop),*command[1:])
+            elif command[0] == "RESTORE" and len(command) == 3:
+                await loop.run_in_executor(self.pool,self.restore,DepotStreamWriter(writer,loop),command[1],command[2])
+            else:
+                writer.write("ERROR Unknown command {}\n".format(command[0]).encode("utf-8"))
+            await writer.drain()
+        except Exception:
+            #Streamed answers cannot carry an error, the client sees the connection closing early
+            logging.exception("Request failed")
+        finally:
+            writer.close()
+            self.clients.discard(task)
+
+    ##
+    ## Requests, run in the request threads
+    ##
+
+    def ingest(self,stream,host,name):
+        data = self.getData()
+        #Blocks deleted since the last request must not be skipped as known
+        self.shareHashIndex(data)
+        depot = Depot(None,host,name,workers=self.ingest_workers,data=data,raw_in=stream)
+        try:
+            depot.process()
+        except Exception:
+            data.db.rollback()
+            raise
+        return depot.ingest.cnt_blocks
+
+    def hashes(self,out,format=None,fp_rate=DelibHashExport.BLOOM_FP_RATE):
+        data = self.getData()
+        if format is None:
+            for hash in data._DBHashList():
+                out.write((hash+"\n").encode("utf-8"))
+        else:
+            with open(data.getHashExportPath(format,float(fp_rate)),"rb") as fp:
+                shutil.copyfileobj(fp,out)
+        out.flush()
+
+    def restore(self,out,host,name):
+        with DelibRestore(data=self.getData(),host=host,name=name,workers=self.restore_workers) as restore:
+            for block in restore:
+                block.writeFP(out,compressed=False)
+        out.flush()
+
+
+
+def parse_arguments():
+     parser = argparse.ArgumentParser()
+     parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     group = parser.add_mutually_exclusive_group(required=True)
+     group.add_argument("--socket",nargs=1,help="Unix socket path")
+     group.add_argument("--listen",nargs=1,help="TCP address as host:port. No authentication, use a trusted network or SSH forwarding")
+     parser.add_argument("--workers",nargs=1,required=False,default=[8],type=int,help="Requests served at once (Default: 8)")
+     parser.add_argument("--ingest-workers",nargs=1,required=False,default=[1],type=int,help="Threads storing new blocks per ingest (Default: 1)")
+     parser.add_argument("--restore-workers",nargs=1,required=False,default=[1],type=int,help="Threads reading blocks ahead per restore (Default: 1)")
+     parser.add_argument("--cache",nargs=1,required=False,default=["256M"],help="Memory for decompressed blocks shared by all restores, 0 to disable (Default: 256M)")
+     args = parser.parse_args()
+     return args
+
+
+if __name__ == "__main__":
+    logging.debug("Called: __main__")
+    args = parse_arguments()
+    logging.info("Starting DepotServer()")
+    socket_path = args.socket[0] if args.socket else None
+    listen = args.listen[0] if args.listen else None
+    server = DepotServer(dir=args.dir[0],socket_path=socket_path,listen=listen,workers=args.workers[0],ingest_workers=args.ingest_workers[0],restore_workers=args.restore_workers[0],cache_size=humanfriendly.parse_size(args.cache[0],binary=True))
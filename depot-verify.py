@@ -2,54 +2,183 @@
 Depot-Verify - Datastore hash <-> block validation
 """
 
-import argparse,humanfriendly,logging,os       #Helpers
-from delib import Delib,DelibDataDir,DelibBlock    #Dedup-Server
+import argparse,humanfriendly,logging,os,time,collections,concurrent.futures       #Helpers
+from delib import Delib,DelibDataDir,DelibBlock,DelibRateLimit,DelibRestore    #Dedup-Server
 
 LOGLEVEL=logging.INFO
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
 
 
+#Datastore of a worker process, opened once by _initWorker()
+worker_data = None
+
+def _initWorker(dir):
+    global worker_data
+    worker_data = DelibDataDir(dir)
+
+#Worker stage: reads and hashes a batch of block rows. Returns (hash,error) for each, error is None if the block is ok
+def _verifyBlocks(rows):
+    results = []
+    for row in rows:
+        hash = DelibBlock.intToHash(row["hash"])
+        try:
+            block = worker_data.readBlock(row)
+            if block.getHash() != hash:
+                results.append((hash,"Block {} is corrupt: content has hash {}".format(hash,block.getHash())))
+            else:
+                results.append((hash,None))
+        except Exception as e:
+            results.append((hash,"Could not read block {}, {}".format(hash,str(e))))
+    return results
+
+
 class DepotVerify(Delib):
 
-    VERSION = 2019.300 #Year.Yearday
+    VERSION = 2026.290 #Year.Yearday
 
-    def __init__(self,dir):
+    BATCH = 64                  #Blocks per worker task
+    QUEUE_PER_WORKER = 4        #Tasks in flight per worker
+    CHECKPOINT_INTERVAL = 10    #Seconds between commits of verified blocks
+
+    def __init__(self,dir,workers=1,max_rate=0,older_than=None,restart=False):
+        global worker_data
         logging.info("Datastore directory {}".format(dir))
         self.data = DelibDataDir(dir)
         bad_blocks = []
-        bad_backups = {}
 
-        logging.info("Verifying blocks")
-        for row in self.data.cur.execute("SELECT * FROM blocks ORDER BY ROWID ASC"):
-            logging.debug("Verifying {}".format(row["hash"]))
-            filepath=self.data.dir + "/blocks/" + row["filename"]
-            try:
-                block = DelibBlock.fromFile (file=filepath , compressed = row["compressed"] )
-                if block.getHash() != row["hash"]:
-                    logging.error("{} should have hash {} but has {}".format(filepath,row["hash"],block.getHash()))
-                    bad_blocks.append(row["hash"])
-            except Exception as e:
-                logging.error("Could not read block {}, {}".format(row["hash"],str(e)))
-                bad_blocks.append(row["hash"])
+        #Blocks verified after the cutoff second are skipped, a run in the same second as the last one verifies
+        #all blocks again. An interrupted run is continued with its cutoff
+        cutoff = self.data.settings.get("verify_cutoff")
+        if cutoff is not None and not restart:
+            cutoff = int(cutoff)
+            logging.info("Resuming interrupted verify of blocks not verified since {}".format(time.strftime("%Y-%m-%d_%H-%M-%S",time.localtime(cutoff))))
+        else:
+            cutoff = int(time.time()) - (older_than or 0)
+            self.data._DBSetSetting("verify_cutoff",cutoff)
+
+        total = self.data.cur.execute("SELECT COUNT(*) FROM blocks WHERE time_verified IS NULL OR time_verified <= :cutoff",{ "cutoff": cutoff }).fetchone()[0]
+        logging.info("Verifying {} blocks".format(total))
+
+        if workers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,initializer=_initWorker,initargs=(dir,))
+        else:
+            pool = None
+            worker_data = self.data
+        limit = DelibRateLimit(max_rate)
+        pending = collections.deque()
+        verified = []
+        checkpoint = time.monotonic()
+        cnt_verified = 0
+
+        #On-disk order: packs by offset, then block files by name. The ORDER BY sorts all rows upfront,
+        #so committing time_verified while reading is safe
+        rows = self.data.db.execute("SELECT hash,csize,compressed,filename,pack,pack_offset FROM blocks WHERE time_verified IS NULL OR time_verified <= :cutoff ORDER BY pack ASC, pack_offset ASC, filename ASC",{ "cutoff": cutoff })
+        while True:
+            batch = [dict(row) for row in rows.fetchmany(self.BATCH)]
+            if batch:
+                limit.consume(sum(row["csize"] or 0 for row in batch))
+                if pool:
+                    pending.append(pool.submit(_verifyBlocks,batch))
+                else:
+                    pending.append(_verifyBlocks(batch))
+            if not pending:
+                break
+            if batch and pool and len(pending) < workers * self.QUEUE_PER_WORKER:
+                continue
+            results = pending.popleft()
+            if pool:
+                results = results.result()
+            for hash,error in results:
+                if error:
+                    logging.error(error)
+                    bad_blocks.append(hash)
+                else:
+                    logging.debug("Verified {}".format(hash))
+                    verified.append({ "hash": DelibBlock.hashToInt(hash), "time": int(time.time()) })
+            cnt_verified += len(results)
+            #Checkpoint: blocks verified so far are skipped when resuming
+            if time.monotonic() - checkpoint >= self.CHECKPOINT_INTERVAL:
+                self._checkpoint(verified)
+                verified = []
+                checkpoint = time.monotonic()
+                logging.info("Verified {} of {} blocks".format(cnt_verified,total))
+        self._checkpoint(verified)
+        if pool:
+            pool.shutdown()
+        self.data.cur.execute("DELETE FROM settings WHERE key = 'verify_cutoff'")
+        self.data.db.commit()
+        logging.info("Done verifying {} blocks".format(cnt_verified))
 
         if len(bad_blocks) == 0:
             logging.info("Success! No failed blocks!")
             return
-        else:
-            for bad_block in bad_blocks:
-                for bad_backup in self.data.cur.execute("SELECT ba.rowid,ba.name,ba.host,ba.state FROM blocks bl LEFT JOIN backup_blocks bb ON bl.hash = bb.block LEFT JOIN backups ba ON bb.backup = ba.rowid WHERE bl.hash = :hash AND ba.state = 'ready' OR state = 'broken'",{ "hash": bad_block }):
-                    if bad_backup["state"] == "ready":
-                        logging.warn("Marking backup {} (host {}, name {}) as broken due to at least hash {} failing.".format(bad_backup["rowid"],bad_backup["host"],bad_backup["name"],bad_block))
-                        self.data.cur.execute("UPDATE backups SET state = 'failed' WHERE rowid = :rowid", {'rowid': bad_backup["rowid"] } )
-                        self.data.db.commit()
-                    bad_backups[bad_backup["host"]+":"+bad_backup["name"]] = True
-
-        all_failed_backups = ", ".join(list(bad_backups.keys()))
+
+        bad_backups = self._markBroken(bad_blocks)
+        blocksize = int(self.data.getBlocksize())
+        for backup in bad_backups.values():
+            if self.data.getChunking() == self.data.CHUNKING_CDC:
+                #Blocks vary in size, the offsets are summed up along the backup
+                with DelibRestore(data=self.data,host=backup["host"],name=backup["name"]) as restore:
+                    byte_ranges = restore.getByteRanges(backup["ranges"])
+            else:
+                byte_ranges = [((pos - 1) * blocksize,(pos - 1 + count) * blocksize) for pos,count in backup["ranges"]]
+            ranges = ", ".join("{}-{}".format(start,end) for start,end in byte_ranges)
+            logging.error("Backup {}:{} has failed blocks at bytes {}".format(backup["host"],backup["name"],ranges))
+
+        all_failed_backups = ", ".join(backup["host"]+":"+backup["name"] for backup in bad_backups.values())
         all_failed_hashes = ", ".join(bad_blocks)
 
         logging.error("All failed xhashes: "+all_failed_hashes)
         logging.error("All failed backups: "+all_failed_backups)
 
+    #Marks all ready backups using any of the bad hashes as broken and the bad blocks as unverified in one transaction.
+    #Returns ready and broken backups using them by ROWID with their affected position ranges as (pos,count)
+    def _markBroken(self,bad_blocks):
+        self.data.db.commit()
+        self.data.cur.execute("BEGIN")
+        self.data.cur.execute("CREATE TEMP TABLE bad_blocks(hash INTEGER PRIMARY KEY) WITHOUT ROWID")
+        self.data.cur.executemany("INSERT OR IGNORE INTO bad_blocks(hash) VALUES (?)",((DelibBlock.hashToInt(hash),) for hash in bad_blocks))
+        #Bad blocks are verified again by every later run, also with --older-than, e.g. once they are re-imported
+        self.data.cur.execute("UPDATE blocks SET time_verified = NULL WHERE hash IN (SELECT hash FROM bad_blocks)")
+        self.data.cur.execute("CREATE TEMP TABLE bad_backups(backup INTEGER PRIMARY KEY)")
+
+        bad_backups = {}
+        def addRange(backup,pos,count):
+            if backup["rowid"] not in bad_backups:
+                bad_backups[backup["rowid"]] = { "host": backup["host"], "name": backup["name"], "ranges": [] }
+            ranges = bad_backups[backup["rowid"]]["ranges"]
+            #Merge adjacent ranges
+            if ranges and ranges[-1][0] + ranges[-1][1] == pos:
+                ranges[-1] = (ranges[-1][0],ranges[-1][1] + count)
+            else:
+                ranges.append((pos,count))
+
+        #Backups linked in the database, through the index on backup_blocks(block)
+        for row in self.data.db.execute("SELECT ba.rowid,ba.host,ba.name,bb.pos,bb.count FROM bad_blocks x JOIN backup_blocks bb ON bb.block = x.hash JOIN backups ba ON ba.rowid = bb.backup WHERE ba.state IN ('ready','broken') ORDER BY bb.backup ASC, bb.pos ASC"):
+            addRange(row,row["pos"],row["count"])
+        #Backups linked as block map
+        bad_values = set(DelibBlock.hashToInt(hash) for hash in bad_blocks)
+        for backup in self.data.getBlockMapBackups(states=(self.data.STATE_READY,self.data.STATE_BROKEN)):
+            blockmap = self.data.getBlockMap(backup["rowid"])
+            pos = 1
+            for value,count in blockmap.runs():
+                if value in bad_values:
+                    addRange(backup,pos,count)
+                pos += count
+            blockmap.close()
+
+        self.data.cur.executemany("INSERT INTO bad_backups(backup) VALUES (?)",((rowid,) for rowid in bad_backups))
+        self.data.cur.execute("UPDATE backups SET state = 'broken' WHERE state = 'ready' AND ROWID IN (SELECT backup FROM bad_backups)")
+        logging.warning("Marked {} backups as broken".format(self.data.cur.rowcount))
+        self.data.cur.execute("DROP TABLE bad_blocks")
+        self.data.cur.execute("DROP TABLE bad_backups")
+        self.data.db.commit()
+        return bad_backups
+
+    def _checkpoint(self,verified):
+        self.data.cur.executemany("UPDATE blocks SET time_verified = :time WHERE hash = :hash",verified)
+        self.data.db.commit()
+
 
 
 
@@ -58,6 +187,10 @@ class DepotVerify(Delib):
 def parse_arguments():
      parser = argparse.ArgumentParser()
      parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
+     parser.add_argument("--workers",nargs=1,required=False,default=[1],type=int,help="Processes reading and hashing blocks (Default: 1)")
+     parser.add_argument("--max-rate",nargs=1,required=False,default=["0"],help="Maximum read rate of compressed blocks per second, 0 for unlimited. Human-readable B|KB|MB|GB (Default: 0)")
+     parser.add_argument("--older-than",nargs=1,required=False,default=[None],help="Only verify blocks not verified within this timespan, e.g. 30d (Default: all blocks)")
+     parser.add_argument("--restart",action="store_true",help="Start over instead of resuming an interrupted verify")
      args = parser.parse_args()
      return args
 
@@ -66,4 +199,5 @@ if __name__ == "__main__":
     logging.debug("Called: __main__")
     args = parse_arguments()
     logging.info("Starting DepotVerify()")
-    dedup = DepotVerify(dir=args.dir[0])
+    older_than = humanfriendly.parse_timespan(args.older_than[0]) if args.older_than[0] else None
+    dedup = DepotVerify(dir=args.dir[0],workers=args.workers[0],max_rate=humanfriendly.parse_size(args.max_rate[0],binary=True),older_than=older_than,restart=args.restart)
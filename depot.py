@@ -7,7 +7,7 @@ Known Issues:
 
 import argparse, logging    #Helpers
 import lz4.frame,tarfile,re            #Dedup
-from delib import Delib,DelibBlock,DelibDataDir,DelibBackup   #Dedup-Server
+from delib import Delib,DelibBlock,DelibDataDir,DelibBackup,DelibIngestPool   #Dedup-Server
 
 LOGLEVEL=logging.INFO
 logging.basicConfig(format='%(asctime)s [Depot] %(levelname)-8s %(message)s', level=LOGLEVEL, datefmt='%Y-%m-%d %H:%M:%S')
@@ -20,21 +20,37 @@ class Depot(Delib):
     SKIP_KNOWN_BLOCKS_ENTIRELY = True   #Skips verifying a known-blocks hash
     SKIP_VERIFYING_BLOCKS = True        #Skips verifying if a block actually has the given hash
                                         #WARNING: Turning on SKIP_VERIFYING_BLOCKS will prevent trasport corruption or malformed blocks from being detected!
-    DELAY_DB_BLOCK_COMMIT = True        #Runs a single commit at the end for all new blocks
-    DELAY_DB_LINK_COMMIT = True         #Runs a single commit at the end for all backup links
 
     STATE_HEADER = 1
     STATE_BODY = 2
     STATE_FOOTER = 3
     STATE_DONE = 4
 
-    def __init__(self,dir_path,host,name):
-        dir = DelibDataDir(dir_path)
+    #An open datastore in data and a binary input stream in raw_in replace opening dir_path and STDIN, e.g. for depot-server.py
+    def __init__(self,dir_path,host,name,workers=1,data=None,raw_in=None):
+        dir = data or DelibDataDir(dir_path)
         Delib.__init__(self, dir, host, name)
+        self.workers = workers
         #Prepare reading
-        self.prepareStdin()
+        if raw_in:
+            self.raw_in = raw_in
+        else:
+            self.prepareStdin()
 
     def process(self):
+        self.ingest = None
+        try:
+            self._processTar()
+        except Exception:
+            #Blocks written so far are inserted, so they are reclaimed with the failed backup
+            if self.ingest:
+                try:
+                    self.ingest.close()
+                except Exception:
+                    logging.exception("Could not insert the blocks stored before the failure")
+            raise
+
+    def _processTar(self):
 
         self.state =self.STATE_HEADER
         self.tar = {}
@@ -56,6 +72,9 @@ class Depot(Delib):
                         self.state += 1
                         #Create backup "session"
                         self.backup = DelibBackup(data=self.data,host=self.host,name=self.name,device=self.tar["backup_device"],time_created=self.tar["backup_created"])
+                        #Body blocks are processed by the ingest pool. workers=1 processes inline. Each batch of rows is
+                        #committed so concurrent imports see the blocks and get their claims
+                        self.ingest = DelibIngestPool(self.data,workers=self.workers,do_commit=True)
                         continue
 
                 ##
@@ -65,30 +84,20 @@ class Depot(Delib):
                     #Check if we reached footer
                     matches = re.search("^\/newblocks\/([a-zA-Z0-9]{1,})\.(lz4|tar)$",tarinfo.name)
                     if not matches:
-                        #Commit body blocks before continuing
-                        if self.DELAY_DB_BLOCK_COMMIT:
-                            self.data._DBCommit()
-                        logging.info("TAR-body done")
+                        #Wait for all body blocks to be written and inserted before the footer
+                        self.ingest.close()
+                        logging.info("TAR-body done. Stored {} new blocks".format(self.ingest.cnt_blocks))
                         self.state += 1
                     else:
                         client_hash = matches.group(1)
                         #logging.debug("Processing new block {}".format(client_hash))
 
-                        if not ( self.SKIP_KNOWN_BLOCKS_ENTIRELY and self.data.hashExists(client_hash) ):
-                            #Extract
+                        if not ( self.SKIP_KNOWN_BLOCKS_ENTIRELY and ( self.ingest.isInflight(client_hash) or self.data.hashExists(client_hash) ) ):
+                            #Extract. Must happen here as the TAR is read as stream
                             block = self.fp.extractfile(tarinfo)
                             block = block.read()
-                            if matches.group(2) == "lz4":
-                                block = lz4.frame.decompress(block)
-                            if self.SKIP_VERIFYING_BLOCKS:
-                                block = DelibBlock(block,client_hash)
-                            else:
-                                block = DelibBlock(block)
-                            #Verify transfer with hash
-                            if client_hash != block.getHash():
-                                raise Exception("Client hash {} differs from server hash {} for block {}".format(client_hash,block.getHash(),tarinfo.name))
-                            #Store block
-                            self.data.addBlock(block,do_commit=(not self.DELAY_DB_BLOCK_COMMIT))
+                            #Decompress, verify and store block
+                            self.ingest.submit(block,client_hash,compressed=(matches.group(2) == "lz4"),verify=(not self.SKIP_VERIFYING_BLOCKS),name=tarinfo.name)
                         else:
                             #logging.debug("Skipping known block {} entirely. Fast mode".format(client_hash))
                             pass
@@ -98,17 +107,17 @@ class Depot(Delib):
                 ##
                 if self.state == self.STATE_FOOTER:
                     logging.info("TAR Footer: {}".format(tarinfo.name))
-                    k,v = self.extractTarHeader(tarinfo,self.need_footers)
-                    self.need_footers.remove(tarinfo.name)
+                    if tarinfo.name == "/backup/list" and tarinfo.name in self.need_footers:
+                        #The list is linked while it is streamed, it is never held in memory
+                        self.need_footers.remove(tarinfo.name)
+                        logging.info("Linking backup.")
+                        self.linkBackupList(tarinfo)
+                    else:
+                        k,v = self.extractTarHeader(tarinfo,self.need_footers)
+                        self.need_footers.remove(tarinfo.name)
                     if len(self.need_footers) == 0:
-                        logging.info("TAR complete. Linking backup.")
+                        logging.info("TAR complete.")
                         self.state += 1
-                        #Add backup links
-                        hash_pos = 1
-                        for myhash in self.tar["backup_list"].splitlines():
-                            #logging.debug("Linking hash {}".format(myhash))
-                            self.backup.link(hash_pos,myhash,do_commit=(not self.DELAY_DB_LINK_COMMIT))
-                            hash_pos += 1
                         #Finish backup
                         self.backup.data._DBCommit()
                         self.backup.finish(size=self.tar["backup_filesize"])
@@ -121,6 +130,11 @@ class Depot(Delib):
         else:
             logging.info("Done processing")
 
+    #Links the hashes of the streamed /backup/list member to the backup
+    def linkBackupList(self,tarinfo):
+        cnt = self.backup.linkHashes(self.iterBackupList(tarinfo))
+        logging.info("Linked {} positions".format(cnt))
+
 
 
 def parse_arguments():
@@ -128,6 +142,7 @@ def parse_arguments():
      parser.add_argument("--dir",nargs=1,required=True,help="Datablock directory")
      parser.add_argument("--host",nargs=1,required=True,help="Client hostname")
      parser.add_argument("--name",nargs=1,required=True,help="Backup name")
+     parser.add_argument("--workers",nargs=1,required=False,default=[1],type=int,help="Threads decompressing, verifying and writing new blocks (Default: 1)")
      args = parser.parse_args()
      return args
 
@@ -138,5 +153,5 @@ if __name__ == "__main__":
     logging.info("Starting Depot()")
     host = getattr(args,"host",[None])
     name = getattr(args,"name",[None])
-    depot = Depot(dir_path=args.dir[0],host=host[0],name=name[0])
+    depot = Depot(dir_path=args.dir[0],host=host[0],name=name[0],workers=args.workers[0])
     depot.process()